@@ -0,0 +1,182 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+# Measures device agent startup: wall clock time from process start until the
+# agent has subscribed to its command topic, the import cost recorded by
+# python -X importtime, and optionally the agent's idle CPU use afterwards.
+#
+#  Unlike the other benchmarks this one runs the real client against AWS IoT
+#  Core, so run it on the device (or a machine with the client's certificates)
+#  from an unzipped client.zip. Each run uses a scratch copy of the client
+#  folder, so the certificates in --client-dir are left untouched.
+#
+#  provisioned: the client folder already holds production certificates.
+#  first-boot:  the client folder holds the bootstrap claim certificate; every
+#               run provisions a new certificate (and thing) in the account.
+#
+#  Usage:
+#      python agent_startup_bench.py --client-dir ./client --runs 5
+#      python agent_startup_bench.py --client-dir ./client --mode first-boot --runs 1
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import re
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+subscribedPattern = re.compile(r"^Subscribed to topic '")
+importPattern = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+subscribedTopics = 1
+
+
+def parseImportTime(stderr):
+    """Top level modules (by cumulative microseconds) and the total."""
+    rows = []
+    for line in stderr.splitlines():
+        match = importPattern.match(line)
+        if match:
+            rows.append((len(match.group(3)), int(match.group(2)), match.group(4)))
+    # Top level imports are the least indented rows ('| json'); their
+    # submodules are indented further ('|   json.decoder').
+    top = min(indent for indent, _, _ in rows) if rows else 0
+    modules = [(cumulative, name) for indent, cumulative, name in rows if indent == top]
+    modules.sort(reverse=True)
+    return sum(cumulative for cumulative, _ in modules), modules
+
+
+def cpuSeconds(pid):
+    """utime + stime of a running process from /proc (Linux only)."""
+    with open('/proc/{}/stat'.format(pid)) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def runAgent(clientDir, importTime, timeout, idleSeconds):
+    workDir = tempfile.mkdtemp(prefix='agent-bench-')
+    scratch = os.path.join(workDir, 'client')
+    shutil.copytree(clientDir, scratch, ignore=shutil.ignore_patterns(
+        '__pycache__', 'installer'))
+    command = [sys.executable, '-u']
+    if importTime:
+        command += ['-X', 'importtime']
+    command.append('main.py')
+
+    # importtime writes to stderr; a file avoids the pipe filling up.
+    stderrFile = open(os.path.join(workDir, 'stderr.txt'), 'w+')
+    start = time.monotonic()
+    process = subprocess.Popen(command, cwd=scratch, stdout=subprocess.PIPE,
+                               stderr=stderrFile, universal_newlines=True)
+    result = {'subscribed': None, 'idle_cpu': None}
+    try:
+        subscribed = 0
+        deadline = start + timeout
+        for line in process.stdout:
+            if subscribedPattern.match(line):
+                subscribed += 1
+                if subscribed == subscribedTopics:
+                    result['subscribed'] = time.monotonic() - start
+                    break
+            if time.monotonic() > deadline:
+                break
+        if result['subscribed'] is not None and idleSeconds:
+            before = cpuSeconds(process.pid)
+            time.sleep(idleSeconds)
+            result['idle_cpu'] = (cpuSeconds(process.pid) - before) / idleSeconds
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.communicate(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+        stderrFile.seek(0)
+        result['import_total'], result['imports'] = parseImportTime(
+            stderrFile.read())
+        stderrFile.close()
+        shutil.rmtree(workDir, ignore_errors=True)
+    return result
+
+
+def hasProductionCredentials(clientDir):
+    """Whether the agent starts provisioned, read from the certificate
+    manifest the agent itself uses. Only reads; the agent's rollback and
+    migration of legacy folders are left to the agent."""
+    sys.path.insert(0, os.path.abspath(clientDir))
+    from utils.config_loader import Config
+    from utils.credential_store import CredentialStore
+    settings = Config(os.path.join(clientDir, 'config.ini')).get_section('SETTINGS')
+    store = CredentialStore(os.path.join(clientDir, settings['SECURE_CERT_PATH']))
+    return any(store.manifest.get(slot) and store.verify(store.manifest[slot])
+               for slot in ('active', 'previous'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure device agent startup time and import cost')
+    parser.add_argument('--client-dir', required=True,
+                        help='unzipped client folder with config and certificates')
+    parser.add_argument('--mode', choices=['provisioned', 'first-boot'],
+                        default='provisioned')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds to wait for the agent to subscribe')
+    parser.add_argument('--idle-seconds', type=float, default=0,
+                        help='also measure CPU use while idle after subscribing (Linux)')
+    parser.add_argument('--no-importtime', action='store_true',
+                        help='run without -X importtime, which adds a little overhead')
+    parser.add_argument('--top', type=int, default=10,
+                        help='slowest top level imports to list')
+    args = parser.parse_args()
+
+    hasProduction = hasProductionCredentials(args.client_dir)
+    if hasProduction != (args.mode == 'provisioned'):
+        sys.exit('{} does not match --mode {}: manifest.json {} production '
+                 'credentials (folders from before the manifest are migrated '
+                 'the first time the agent starts)'.format(
+                     args.client_dir, args.mode,
+                     'lists' if hasProduction else 'does not list'))
+
+    startup = []
+    imports = []
+    idle = []
+    slowest = {}
+    for run in range(args.runs):
+        result = runAgent(args.client_dir, not args.no_importtime,
+                          args.timeout, args.idle_seconds)
+        if result['subscribed'] is None:
+            print('run {}: agent did not subscribe within {}s'.format(
+                run + 1, args.timeout))
+            continue
+        startup.append(result['subscribed'])
+        if result['idle_cpu'] is not None:
+            idle.append(result['idle_cpu'])
+        if result['imports']:
+            imports.append(result['import_total'] / 1e6)
+            for cumulative, name in result['imports']:
+                slowest[name] = max(slowest.get(name, 0), cumulative)
+        print('run {}: subscribed after {:.3f}s'.format(run + 1, result['subscribed']))
+
+    if not startup:
+        return 1
+    print('\nmode: {}, runs: {}'.format(args.mode, len(startup)))
+    print('time to subscribed: median {:.3f}s, min {:.3f}s, max {:.3f}s'.format(
+        statistics.median(startup), min(startup), max(startup)))
+    if imports:
+        print('import time: median {:.3f}s'.format(statistics.median(imports)))
+        print('slowest top level imports:')
+        for name, cumulative in sorted(slowest.items(), key=lambda item: -item[1])[:args.top]:
+            print('  {:<40} {:8.1f} ms'.format(name, cumulative / 1000.0))
+    if idle:
+        print('idle CPU: {:.2%} of one core'.format(statistics.median(idle)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+# Compares the pre-provisioning hook's DynamoDB cost and latency per
+# provisioning attempt: the previous GetItem + UpdateItem flow against the
+# single conditional UpdateItem in SubTemplates/IoT/Lambdas/lambda_hook.
+#
+#  Usage:
+#      python Benchmarks/lambda_hook_bench.py --attempts 2000 --latency-ms 4
+# ------------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import io
+import time
+
+import fakes
+
+stateProvisioned = 'active'
+stateWhiteList = 'white_listed'
+
+
+def legacyHandler(hook):
+    """The GetItem followed by UpdateItem flow the hook used before."""
+    def handler(event, context):
+        provision_response = {'allowProvisioning': False}
+        try:
+            id = event['parameters']['SerialNumber']
+            deviceData = hook.dynamoClient.get_item(
+                TableName=hook.resourceTag,
+                Key={'device': {'S': id}})['Item']
+            if deviceData['state']['S'] == stateWhiteList:
+                hook.dynamoClient.update_item(
+                    TableName=hook.resourceTag,
+                    Key={'device': {'S': id}},
+                    UpdateExpression="set #s=:s",
+                    ExpressionAttributeNames={'#s': 'state'},
+                    ExpressionAttributeValues={':s': {'S': stateProvisioned}})
+                provision_response['allowProvisioning'] = True
+        except Exception:
+            pass
+        return provision_response
+    return handler
+
+
+def seed(dynamo, attempts):
+    dynamo.items = {}
+    for i in range(attempts):
+        serial = 'device-{}'.format(i)
+        dynamo.items[serial] = {'device': {'S': serial},
+                                'state': {'S': stateWhiteList}}
+
+
+def run(name, handler, dynamo, serials):
+    dynamo.reset()
+    latencies = []
+    accepted = 0
+    for serial in serials:
+        event = {'parameters': {'SerialNumber': serial}}
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = handler(event, None)
+        latencies.append((time.perf_counter() - start) * 1000)
+        accepted += 1 if response['allowProvisioning'] else 0
+    count = float(len(serials))
+    return {
+        'name': name,
+        'accepted': accepted,
+        'p50': fakes.percentile(latencies, 0.50),
+        'p95': fakes.percentile(latencies, 0.95),
+        'calls': sum(dynamo.calls.values()) / count,
+        'rcu': dynamo.rcu / count,
+        'wcu': dynamo.wcu / count
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare lambda_hook DynamoDB cost per provisioning attempt')
+    parser.add_argument('--attempts', type=int, default=2000)
+    parser.add_argument('--latency-ms', type=float, default=4.0,
+                        help='simulated DynamoDB round trip')
+    args = parser.parse_args()
+
+    dynamo = fakes.FakeDynamoDB(latency=args.latency_ms / 1000.0)
+    # lambda_hook creates an s3 client at import to load the whitelist bloom
+    # filter; without it the import fails with KeyError 's3'.
+    s3 = fakes.FakeClient()
+    fakes.installFakeAws({'dynamodb': dynamo, 's3': s3})
+    hook = fakes.loadLambda('lambda_hook_app', 'IoT/Lambdas/lambda_hook', {
+        'ResourceTag': 'benchmark',
+        'StateProvisioned': stateProvisioned,
+        'StateWhiteList': stateWhiteList})
+
+    whitelisted = ['device-{}'.format(i) for i in range(args.attempts)]
+    unknown = ['unknown-{}'.format(i) for i in range(args.attempts)]
+    scenarios = [('white listed', whitelisted),
+                 ('already provisioned (replay)', whitelisted),
+                 ('unknown serial', unknown)]
+
+    print('{:<8} {:<30} {:>9} {:>9} {:>9} {:>7} {:>7} {:>7}'.format(
+        'handler', 'scenario', 'accepted', 'p50 ms', 'p95 ms', 'calls', 'RCU', 'WCU'))
+    for name, handler in [('before', legacyHandler(hook)), ('after', hook.handler)]:
+        seed(dynamo, args.attempts)
+        for scenario, serials in scenarios:
+            result = run(name, handler, dynamo, serials)
+            print('{:<8} {:<30} {:>9} {:>9.2f} {:>9.2f} {:>7.2f} {:>7.2f} {:>7.2f}'.format(
+                name, scenario, result['accepted'], result['p50'], result['p95'],
+                result['calls'], result['rcu'], result['wcu']))
+
+
+if __name__ == '__main__':
+    main()
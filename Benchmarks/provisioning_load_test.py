@@ -0,0 +1,192 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+# Simulates a factory batch of devices booting at once and running fleet
+# provisioning by claim: N ProvisioningHandler clients from the edge client
+# connect to an in-process broker (fakes.FakeBroker) emulating the
+# CreateKeysAndCertificate and RegisterThing MQTT APIs, which calls the real
+# lambda_hook handler against an in-memory DynamoDB table.
+#
+#  Reports throughput, outcomes and p50/p95/p99 per phase (claim connect,
+#  create keys, register thing, production connect, validate cert).
+#
+#  Usage:
+#      python Benchmarks/provisioning_load_test.py --devices 2000 --latency-ms 20
+#      python Benchmarks/provisioning_load_test.py --devices 2000 --register-tps 50
+#      python Benchmarks/provisioning_load_test.py --devices 2000 --create-tps 50 --startup-spread 30
+# ------------------------------------------------------------------------------
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import fakes
+
+clientDir = os.path.join(fakes.repoRoot, 'SubTemplates', 'IoT', 'Lambdas',
+                         'provision_device', 'client')
+templateName = 'load_test_template'
+stateProvisioned = 'active'
+stateWhiteList = 'white_listed'
+phases = ['claim_connect', 'create_keys', 'register_thing',
+          'production_connect', 'validate_cert']
+
+configTemplate = """[SETTINGS]
+IOT_ENDPOINT = load-test.local
+REGION = us-east-1
+SECURE_CERT_PATH = {certs}
+MACHINE_CONFIG_PATH = {machine}
+ROOT_CERT = root.ca.pem
+BOOTSTRAP_CLAIM_CERT = bootstrap-certificate.pem.crt
+BOOTSTRAP_SECURE_KEY = bootstrap-private.pem.key
+PROVISIONING_TEMPLATE_NAME = {template}
+PROVISIONING_STEP_TIMEOUT = {timeout}
+PROVISIONING_MAX_ATTEMPTS = {attempts}
+PROVISIONING_BACKOFF_BASE = {base}
+PROVISIONING_BACKOFF_MAX = {cap}
+PROVISIONING_STARTUP_SPREAD = {spread}
+"""
+
+
+def writeConfig(workDir, stepTimeout, attempts=5, base=2, cap=120, spread=0):
+    certs = os.path.join(workDir, 'certs')
+    os.makedirs(certs)
+    machine = os.path.join(workDir, 'machine_config.json')
+    with open(machine, 'w') as machineFile:
+        machineFile.write('{"device_id": "unused", "model_type": "load-test"}')
+    path = os.path.join(workDir, 'config.ini')
+    with open(path, 'w') as configFile:
+        configFile.write(configTemplate.format(
+            certs=certs, machine=machine, template=templateName, timeout=stepTimeout,
+            attempts=attempts, base=base, cap=cap, spread=spread))
+    return path
+
+
+async def provisionDevice(handlerClass, configPath, broker, deviceId, slots, results):
+    async with slots:
+        handler = handlerClass(configPath, connection_factory=broker.connection,
+                               device_id=deviceId, model_type='load-test')
+        start = time.monotonic()
+        outcome = 'provisioned'
+        try:
+            connection = await handler.provision()
+            await asyncio.wrap_future(connection.disconnect())
+        except Exception as e:
+            outcome = str(e).split(':')[0]
+        results.append({'device': deviceId, 'outcome': outcome,
+                        'total': time.monotonic() - start,
+                        'timings': dict(handler.timings),
+                        'retries': dict(handler.retries)})
+
+
+async def runLoad(args, handlerClass, configPath, broker):
+    slots = asyncio.Semaphore(args.concurrency or args.devices)
+    results = []
+    devices = ['load-{:06d}'.format(i) for i in range(args.devices)]
+    await asyncio.gather(*[provisionDevice(handlerClass, configPath, broker,
+                                           deviceId, slots, results)
+                           for deviceId in devices])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test fleet provisioning with simulated devices')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='devices provisioning at once (default: all)')
+    parser.add_argument('--latency-ms', type=float, default=20.0,
+                        help='simulated device to broker round trip')
+    parser.add_argument('--dynamo-latency-ms', type=float, default=5.0)
+    parser.add_argument('--broker-threads', type=int, default=64,
+                        help='broker worker threads (bounds broker and hook concurrency)')
+    parser.add_argument('--create-tps', type=int, default=0,
+                        help='CreateKeysAndCertificate limit, 0 for none')
+    parser.add_argument('--register-tps', type=int, default=0,
+                        help='RegisterThing limit, 0 for none')
+    parser.add_argument('--unlisted-fraction', type=float, default=0.0,
+                        help='fraction of devices missing from the white list')
+    parser.add_argument('--step-timeout', type=float, default=30)
+    parser.add_argument('--max-attempts', type=int, default=5)
+    parser.add_argument('--backoff-base', type=float, default=1)
+    parser.add_argument('--backoff-max', type=float, default=30)
+    parser.add_argument('--startup-spread', type=float, default=0,
+                        help='seconds the devices spread their first attempt over')
+    args = parser.parse_args()
+
+    dynamo = fakes.FakeDynamoDB(latency=args.dynamo_latency_ms / 1000.0)
+    fakes.installFakeAws({'dynamodb': dynamo, 's3': fakes.FakeClient()})
+    fakes.installFakeAwsCrt()
+    hook = fakes.loadLambda('lambda_hook_app', 'IoT/Lambdas/lambda_hook', {
+        'ResourceTag': 'load-test',
+        'StateProvisioned': stateProvisioned,
+        'StateWhiteList': stateWhiteList})
+    sys.path.insert(0, clientDir)
+    from provisioning_handler import ProvisioningHandler
+
+    unlisted = int(args.devices * args.unlisted_fraction)
+    for i in range(unlisted, args.devices):
+        serial = 'load-{:06d}'.format(i)
+        dynamo.items[serial] = {'device': {'S': serial},
+                                'state': {'S': stateWhiteList}}
+
+    broker = fakes.FakeBroker(templateName, hook.handler,
+                              latency=args.latency_ms / 1000.0,
+                              threads=args.broker_threads,
+                              createTps=args.create_tps,
+                              registerTps=args.register_tps)
+    workDir = tempfile.mkdtemp(prefix='provisioning-load-')
+    try:
+        configPath = writeConfig(workDir, args.step_timeout, args.max_attempts,
+                                 args.backoff_base, args.backoff_max, args.startup_spread)
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = asyncio.run(runLoad(args, ProvisioningHandler, configPath, broker))
+        elapsed = time.monotonic() - start
+    finally:
+        broker.shutdown()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    outcomes = {}
+    for result in results:
+        outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+    provisioned = [r for r in results if r['outcome'] == 'provisioned']
+    print('devices: {}, elapsed: {:.2f}s, provisioned: {} ({:.1f} devices/s)'.format(
+        args.devices, elapsed, len(provisioned), len(provisioned) / elapsed))
+    for outcome, count in sorted(outcomes.items()):
+        print('  {:<40} {:>7}'.format(outcome, count))
+
+    print('\n{:<20} {:>9} {:>9} {:>9} {:>9}'.format(
+        'phase (ms)', 'count', 'p50', 'p95', 'p99'))
+    for phase in phases + ['total']:
+        samples = [(r['total'] if phase == 'total' else r['timings'][phase]) * 1000
+                   for r in results if phase == 'total' or phase in r['timings']]
+        print('{:<20} {:>9} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            phase, len(samples), fakes.percentile(samples, 0.50),
+            fakes.percentile(samples, 0.95), fakes.percentile(samples, 0.99)))
+
+    retries = {}
+    for result in results:
+        for step, count in result['retries'].items():
+            retries[step] = retries.get(step, 0) + count
+    print('\nretries: {}'.format(dict(sorted(retries.items())) or 'none'))
+    for api in ('CreateKeysAndCertificate', 'RegisterThing'):
+        seconds = broker.perSecond.get(api, {})
+        if seconds:
+            ramp = [seconds.get(second, 0) for second in range(max(seconds) + 1)]
+            print('{} requests/s: peak {}, per second {}'.format(
+                api, max(ramp), ' '.join(str(count) for count in ramp[:60])))
+
+    print('\nbroker calls: {}'.format(dict(sorted(broker.calls.items()))))
+    print('dynamodb calls: {}, WCU: {:.0f}, RCU: {:.1f}'.format(
+        dict(dynamo.calls), dynamo.wcu, dynamo.rcu))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+# End to end latency and cost of turning SSM on for a device. ToggleSSMFunction
+# runs against in-memory SSM, iot-data and DynamoDB; a simulated device answers
+# cmd/<id>/ssm/activate after a configurable install time by registering with
+# the activation, and the registration is delivered to SetupInstanceFunction as
+# the EventBridge association state change event.
+#
+#  Both Lambdas run on a scaled clock (--time-scale) so minutes of install and
+#  polling take seconds. All reported times are in simulated seconds.
+#
+#  sync:  activate and let ToggleSSMFunction poll DynamoDB every 5s until the
+#         device registers (the default request).
+#  async: activate with "async": true, SetupInstanceFunction records the
+#         registration and the caller reads it with a status request.
+#
+#  Usage:
+#      python Benchmarks/toggle_ssm_bench.py --activations 50 --device-delay 40
+# ------------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import random
+import statistics
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import fakes
+
+stateProvisioned = 'active'
+billingGranularityMs = 1
+
+
+class ScaledClock:
+    """time module stand-in running scale times faster than the wall clock."""
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.realStart = time.monotonic()
+        self.epochStart = time.time()
+
+    def elapsed(self):
+        return (time.monotonic() - self.realStart) * self.scale
+
+    def time(self):
+        return self.epochStart + self.elapsed()
+
+    def monotonic(self):
+        return self.elapsed()
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.scale)
+
+    def module(self):
+        return types.SimpleNamespace(time=self.time, monotonic=self.monotonic,
+                                     sleep=self.sleep, perf_counter=self.monotonic)
+
+
+class SimulatedFleet:
+    """Devices that install the agent and register after a random delay."""
+
+    def __init__(self, ssm, setup, clock, delay, jitter, seed):
+        self.ssm = ssm
+        self.setup = setup
+        self.clock = clock
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.registered = {}
+        self.lock = threading.Lock()
+        self.timers = []
+
+    def onActivate(self, topic, payload):
+        device = topic.split('/')[1]
+        data = json.loads(payload)
+        with self.lock:
+            delay = max(self.random.uniform(self.delay - self.jitter,
+                                            self.delay + self.jitter), 0)
+        timer = threading.Timer(delay / self.clock.scale, self.register,
+                                (device, data))
+        timer.daemon = True
+        self.timers.append(timer)
+        timer.start()
+
+    def register(self, device, data):
+        try:
+            instanceId = self.ssm.register(data['activationId'], data['activationCode'])
+        except fakes.ClientError:
+            return  # the activation was deleted after a timeout
+        event = {'detail': {'detailed-status': 'Associated', 'instance-id': instanceId}}
+        start = self.clock.monotonic()
+        self.setup.handler(event, None)
+        with self.lock:
+            self.registered[device] = {'at': self.clock.monotonic(),
+                                       'billed': self.clock.monotonic() - start}
+
+
+def billedMs(seconds):
+    return math.ceil(seconds * 1000 / billingGranularityMs) * billingGranularityMs
+
+
+def activate(toggle, dynamo, clock, device, mode, statusInterval):
+    start = clock.monotonic()
+    event = {'device_id': device, 'action': 'activate'}
+    if mode == 'async':
+        event['async'] = True
+    invocations = [clock.monotonic()]
+    response = toggle.handler(event, fakes.FakeLambdaContext())
+    invocations[0] = clock.monotonic() - invocations[0]
+    returned = clock.monotonic() - start
+    result = {'device': device, 'start': start, 'returned': returned,
+              'invocations': invocations}
+    if mode == 'sync':
+        result['ok'] = 'SSM registered' in str(response)
+        return result
+
+    # The caller polls the status action until the device is registered.
+    token = response['requestToken']
+    while True:
+        clock.sleep(statusInterval)
+        invoked = clock.monotonic()
+        status = toggle.handler({'device_id': device, 'action': 'status',
+                                 'request_token': token}, fakes.FakeLambdaContext())
+        invocations.append(clock.monotonic() - invoked)
+        if isinstance(status, dict) and status['state'] != 'pending':
+            result['ok'] = status['state'] == 'registered'
+            result['returned'] = clock.monotonic() - start
+            return result
+        if not isinstance(status, dict):
+            result['ok'] = False
+            return result
+
+
+def runMode(mode, args, clients, toggle, fleet, clock):
+    dynamo = clients['dynamodb']
+    devices = ['bench-{}-{:05d}'.format(mode, i) for i in range(args.activations)]
+    for device in devices:
+        dynamo.items[device] = {'device': {'S': device},
+                                'state': {'S': stateProvisioned}}
+    for client in clients.values():
+        client.reset()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(
+                lambda device: activate(toggle, dynamo, clock, device, mode,
+                                        args.status_interval), devices))
+
+    registered = []
+    waits = []
+    billed = []
+    for result in results:
+        waits.append(result['returned'])
+        setup = fleet.registered.get(result['device'])
+        total = sum(billedMs(duration) for duration in result['invocations'])
+        if setup:
+            registered.append(setup['at'] - result['start'])
+            total += billedMs(setup['billed'])
+        billed.append(total)
+    count = float(len(results))
+    return {
+        'mode': mode,
+        'ok': sum(1 for result in results if result['ok']),
+        'registered': registered,
+        'waits': waits,
+        'billed': statistics.mean(billed),
+        'gbs': statistics.mean(billed) / 1000.0 * args.memory_mb / 1024.0,
+        'gets': dynamo.calls.get('GetItem', 0) / count,
+        'rcu': dynamo.rcu / count,
+        'wcu': dynamo.wcu / count
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark SSM activation latency and Lambda/DynamoDB cost')
+    parser.add_argument('--activations', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--device-delay', type=float, default=40,
+                        help='mean seconds for a device to install the agent and register')
+    parser.add_argument('--device-jitter', type=float, default=15)
+    parser.add_argument('--activation-timeout', type=int, default=120)
+    parser.add_argument('--status-interval', type=float, default=5,
+                        help='seconds between status calls in async mode')
+    parser.add_argument('--memory-mb', type=int, default=128)
+    parser.add_argument('--time-scale', type=float, default=100)
+    parser.add_argument('--latency-ms', type=float, default=10,
+                        help='simulated AWS API round trip (simulated ms)')
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    clock = ScaledClock(args.time_scale)
+    latency = args.latency_ms / 1000.0 / args.time_scale
+    clients = {
+        'dynamodb': fakes.FakeDynamoDB(latency),
+        'ssm': fakes.FakeSSM(latency),
+        'iot-data': fakes.FakeIotData(latency),
+        'iot': fakes.FakeClient(latency)
+    }
+    fakes.installFakeAws(clients)
+    toggle = fakes.loadLambda('toggle_ssm_app', 'SSM/Lambdas/toggle_ssm', {
+        'ResourceTag': 'benchmark',
+        'AutomationServiceRole': 'benchmark-role',
+        'StateProvisioned': stateProvisioned,
+        'ActivationTimeout': str(args.activation_timeout),
+        'CreateActivationTps': '1000'})
+    setup = fakes.loadLambda('setup_instance_registered_app',
+                             'SSM/Lambdas/setup_instance_registered', {})
+    toggle.time = clock.module()
+    setup.time = clock.module()
+
+    fleet = SimulatedFleet(clients['ssm'], setup, clock, args.device_delay,
+                           args.device_jitter, args.seed)
+    clients['iot-data'].subscribe('cmd/+/ssm/activate', fleet.onActivate)
+
+    print('{} activations, device install {}s +/- {}s, simulated seconds\n'.format(
+        args.activations, args.device_delay, args.device_jitter))
+    print('{:<6} {:>5} {:>9} {:>9} {:>9} {:>10} {:>10} {:>10} {:>9} {:>6} {:>6} {:>6}'.format(
+        'mode', 'ok', 'reg p50', 'reg p95', 'reg p99', 'caller p50', 'caller p95',
+        'billed ms', 'GB-s', 'gets', 'RCU', 'WCU'))
+    for mode in args.modes.split(','):
+        result = runMode(mode, args, clients, toggle, fleet, clock)
+        registered = result['registered']
+        print('{:<6} {:>5} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f} {:>10.1f} {:>10.0f} {:>9.4f} {:>6.1f} {:>6.1f} {:>6.1f}'.format(
+            mode, result['ok'],
+            fakes.percentile(registered, 0.50), fakes.percentile(registered, 0.95),
+            fakes.percentile(registered, 0.99),
+            fakes.percentile(result['waits'], 0.50), fakes.percentile(result['waits'], 0.95),
+            result['billed'], result['gbs'], result['gets'], result['rcu'], result['wcu']))
+    print('\nreg: activate request to registration recorded by SetupInstanceFunction')
+    print('caller: activate request until the caller sees the result')
+    print('billed: ToggleSSMFunction (incl. status calls) + SetupInstanceFunction per activation')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,51 +6,101 @@
 import boto3
 import json
 import os
+import time
+from cache import BloomFilter, NegativeCache
 
 dynamoClient = boto3.client('dynamodb')
+s3Client = boto3.client('s3')
 
 resourceTag = os.environ['ResourceTag']
 stateProvisioned = os.environ['StateProvisioned']
 stateWhiteList = os.environ['StateWhiteList']
+whitelistBloomBucket = os.environ.get('WhitelistBloomBucket', '')
+whitelistBloomKey = os.environ.get('WhitelistBloomKey', '')
+whitelistBloomMaxAge = int(os.environ.get('WhitelistBloomMaxAge', 900))
+statsInterval = 100
 
-provision_response = {'allowProvisioning': False}
+# Warm container state: rejected serials are remembered for NegativeCacheTtl
+# seconds so replayed or misconfigured devices do not consume capacity.
+negativeCache = NegativeCache(int(os.environ.get('NegativeCacheSize', 10000)),
+                              int(os.environ.get('NegativeCacheTtl', 300)))
+whitelistBloom = None
+whitelistBloomLoaded = 0
+invocations = 0
 
 
-def dynamoGet(device_id):
-    try:
-        response = dynamoClient.get_item(
-            TableName=resourceTag,
-            Key={'device': {'S': device_id}}
-        )
-        return response['Item']
-    except Exception:
-        raise Exception('No managed instance with this device id tag')
+def loadWhitelistBloom():
+    global whitelistBloom, whitelistBloomLoaded
+    if not whitelistBloomKey:
+        return None
+    if whitelistBloom is None or time.time() - whitelistBloomLoaded > whitelistBloomMaxAge:
+        whitelistBloomLoaded = time.time()
+        try:
+            response = s3Client.get_object(
+                Bucket=whitelistBloomBucket,
+                Key=whitelistBloomKey
+            )
+            whitelistBloom = BloomFilter.fromBytes(response['Body'].read())
+        except Exception as e:
+            print('error loading whitelist bloom filter', e)
+    return whitelistBloom
+
+
+def isKnownInvalid(device_id):
+    bloom = loadWhitelistBloom()
+    if bloom is not None and device_id not in bloom:
+        return True
+    return negativeCache.contains(device_id)
 
 
-def dynamoUpdate(device_id):
-    dynamoClient.update_item(
+def logCacheStats():
+    global invocations
+    invocations += 1
+    if invocations % statsInterval == 0:
+        stats = {'negativeCache': negativeCache.stats()}
+        if whitelistBloom is not None:
+            stats['whitelistBloom'] = whitelistBloom.stats()
+        print(json.dumps(stats))
+
+
+def dynamoProvision(device_id):
+    # Single round trip: flips a white listed device to provisioned and fails
+    # the condition for unknown, already provisioned or replayed serials.
+    # A failed condition still costs 1 WCU (a read was 0.5 RCU), so the
+    # handler rejects cached and bloom-filtered serials before calling this.
+    response = dynamoClient.update_item(
         TableName=resourceTag,
         Key={'device': {'S': device_id}},
         UpdateExpression="set #s=:s",
+        ConditionExpression="#s = :w",
         ExpressionAttributeNames={
             '#s': 'state'
         },
         ExpressionAttributeValues={
-            ':s': {'S': stateProvisioned}
+            ':s': {'S': stateProvisioned},
+            ':w': {'S': stateWhiteList}
         },
+        ReturnValues='ALL_NEW'
     )
+    return response['Attributes']
 
 
 def handler(event, context):
+    provision_response = {'allowProvisioning': False}
     try:
         # Future log Cloudwatch logs
         print(event)
         id = event['parameters']['SerialNumber']
-        deviceData = dynamoGet(id)
-        print(deviceData)
-        if deviceData['state']['S'] == stateWhiteList:
-            dynamoUpdate(id)
+        if isKnownInvalid(id):
+            print('Invalid device (cached)')
+        else:
+            deviceData = dynamoProvision(id)
+            print(deviceData)
             provision_response["allowProvisioning"] = True
+    except dynamoClient.exceptions.ConditionalCheckFailedException:
+        negativeCache.add(id)
+        print('Invalid device')
     except:
         print('Invalid device')
+    logCacheStats()
     return provision_response
@@ -0,0 +1,116 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import hashlib
+import math
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+bloomMagic = b'BLM1'
+bloomHeader = struct.Struct('>4sII')
+
+
+class NegativeCache:
+    """Size bounded, TTL bounded set of recently rejected keys. The oldest
+    entry is evicted once maxSize is reached."""
+
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def contains(self, key):
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                expires = None
+            if expires is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, key):
+        if self.maxSize <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = time.monotonic() + self.ttl
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class BloomFilter:
+    """Bloom filter over device serials. Serialized as a 12 byte header
+    (magic, bit count, hash count) followed by the bit array."""
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+        self.checks = 0
+        self.rejections = 0
+
+    @classmethod
+    def forCapacity(cls, capacity, errorRate=0.01):
+        # m = -n ln(p) / ln(2)^2, k = m / n ln(2)
+        capacity = max(capacity, 1)
+        size = int(-capacity * math.log(errorRate) / (math.log(2) ** 2)) + 1
+        hashes = max(int(round(size / float(capacity) * math.log(2))), 1)
+        return cls(size, hashes)
+
+    @classmethod
+    def fromBytes(cls, data):
+        magic, size, hashes = bloomHeader.unpack_from(data)
+        if magic != bloomMagic:
+            raise ValueError('Not a bloom filter')
+        bits = bytearray(data[bloomHeader.size:])
+        if len(bits) != (size + 7) // 8:
+            raise ValueError('Truncated bloom filter')
+        return cls(size, hashes, bits)
+
+    def toBytes(self):
+        return bloomHeader.pack(bloomMagic, self.size, self.hashes) + bytes(self.bits)
+
+    def positions(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        h1, h2 = struct.unpack_from('>QQ', digest)
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        self.checks += 1
+        for position in self.positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                self.rejections += 1
+                return False
+        return True
+
+    def stats(self):
+        return {'checks': self.checks, 'rejections': self.rejections}
+
@@ -5,17 +5,28 @@
 
 import cfnresponse
 import boto3
+import csv
+import hashlib
 import os
 import sys
 import json
+import tempfile
+import threading
+import time
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import RateLimiter
 from urllib.request import urlopen
-from zipfile import ZipFile, ZIP_DEFLATED
-import io
 from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED
+import bundle_builder
+from bundle_builder import S3MultipartWriter
 
-iotClient = boto3.client('iot')
+adaptiveRetries = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+iotClient = boto3.client('iot', config=adaptiveRetries)
 s3Client = boto3.client('s3')
-ssmClient = boto3.client('ssm')
+ssmClient = boto3.client('ssm', config=adaptiveRetries)
+lambdaClient = boto3.client('lambda')
 
 resourceTag = os.environ['ResourceTag']
 bucket = os.environ['SsmOnDemandBucket']
@@ -37,6 +48,37 @@ claimCertName = 'bootstrap-certificate.pem.crt'
 certKeyName = 'bootstrap-private.pem.key'
 claimCertPath = '{}/{}'.format(certsPrefix, claimCertName)
 certKeyPath = '{}/{}'.format(certsPrefix, certKeyName)
+configName = 'config.ini'
+clientKey = 'client.zip'
+machineConfigName = 'machine_config.json'
+renderedFiles = {configName}
+factoryRenderedFiles = {configName, machineConfigName}
+factoryPrefix = 'factory'
+factoryWorkers = 32
+s3DeleteLimit = 1000
+
+teardownCheckpoint = 'TeardownCheckpoint'
+teardownWorkers = 16
+teardownMarginMillis = 30000
+# CloudFormation waits an hour for a custom resource response; stop handing
+# the teardown over early enough for the last invocation to answer in time.
+cfnResponseTimeoutSeconds = 3600
+teardownBudgetSeconds = cfnResponseTimeoutSeconds - 600
+teardownMaxIdlePasses = 3
+# Calls per second for each IoT and SSM API used during teardown, kept under
+# the account's default API limits.
+apiLimiters = {
+    'ListThingPrincipals': RateLimiter(20),
+    'ListAttachedPolicies': RateLimiter(20),
+    'DetachPolicy': RateLimiter(15),
+    'DeletePolicy': RateLimiter(10),
+    'DetachThingPrincipal': RateLimiter(20),
+    'UpdateCertificate': RateLimiter(10),
+    'DeleteCertificate': RateLimiter(10),
+    'DeleteThing': RateLimiter(20),
+    'DeleteActivation': RateLimiter(10),
+    'DeregisterManagedInstance': RateLimiter(10)
+}
 
 
 def s3Put(bucket, key, body):
@@ -47,60 +89,95 @@ def s3Put(bucket, key, body):
     )
 
 
-def s3UploadFileObject(data, key):
-    s3Client.upload_fileobj(data, bucket, key)
+def s3List():
+    keys = []
+    paginator = s3Client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+    return keys
+
+
+def s3DeleteKeys(bucket, keys):
+    for i in range(0, len(keys), s3DeleteLimit):
+        s3Client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key}
+                                for key in keys[i:i + s3DeleteLimit]]}
+        )
 
 
-def s3List():
-    return s3Client.list_objects(
-        Bucket=bucket
-    )
+def runConcurrently(name, function, ids):
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=teardownWorkers) as executor:
+        results = list(executor.map(function, ids))
+    counts = {'name': name, 'found': len(ids), 'deleted': results.count(True),
+              'failed': results.count(False), 'seconds': round(time.time() - started, 1)}
+    print(counts)
+    return counts
 
 
-def s3Delete(bucket, key):
-    s3Client.delete_object(
-        Bucket=bucket,
-        Key=key
-    )
+def deleteActivation(activationId):
+    try:
+        limited('DeleteActivation')
+        ssmClient.delete_activation(
+            ActivationId=activationId
+        )
+        return True
+    except:
+        print('error deleting activation {}'.format(activationId))
+        return False
 
 
 def clearActivations():
     try:
-        activations = ssmClient.describe_activations()
-        for activation in activations['ActivationList']:
-            if activation['Description'] == resourceTag:
-                try:
-                    ssmClient.delete_activation(
-                        ActivationId=activation['ActivationId']
-                    )
-                except:
-                    print('error deleting activation {}'.format(
-                        activation['ActivationId']))
+        activationIds = []
+        paginator = ssmClient.get_paginator('describe_activations')
+        pages = paginator.paginate(Filters=[{
+            'FilterKey': 'DefaultInstanceName',
+            'FilterValues': [resourceTag]
+        }])
+        for page in pages:
+            for activation in page['ActivationList']:
+                if activation['Description'] == resourceTag:
+                    activationIds.append(activation['ActivationId'])
+        return runConcurrently('activations', deleteActivation, activationIds)
     except:
         print('error clearing activations')
 
 
+def deregisterInstance(instanceId):
+    try:
+        limited('DeregisterManagedInstance')
+        ssmClient.deregister_managed_instance(
+            InstanceId=instanceId
+        )
+        return True
+    except:
+        print('error deregistering {}'.format(instanceId))
+        return False
+
+
 def clearRegistrations():
     try:
-        instances = ssmClient.describe_instance_information()
-        for instance in instances['InstanceInformationList']:
-            if(instance['Name'] == resourceTag):
-                try:
-                    ssmClient.deregister_managed_instance(
-                        InstanceId=instance['InstanceId']
-                    )
-                except:
-                    print('error deregistering {}'.format(
-                        instance['InstanceId']))
+        instanceIds = []
+        paginator = ssmClient.get_paginator('describe_instance_information')
+        pages = paginator.paginate(Filters=[{
+            'Key': 'tag:Project',
+            'Values': [resourceTag]
+        }])
+        for page in pages:
+            for instance in page['InstanceInformationList']:
+                instanceIds.append(instance['InstanceId'])
+        return runConcurrently('registrations', deregisterInstance, instanceIds)
     except:
         print('error clearing registrations')
 
 
 def clearBootstrapPolicy():
-    items = s3List()
-    for key in items['Contents']:
-        if key['Key'].split('/')[-1].split('.')[1] == 'id':
-            certId = key['Key'].split('/')[-1].split('.')[0]
+    keys = s3List()
+    for key in keys:
+        if key.startswith(bootstrapPrefix + '/') and key.endswith('.id'):
+            certId = key.split('/')[-1].split('.')[0]
 
     try:
         iotClient.update_certificate(
@@ -124,8 +201,7 @@ def clearBootstrapPolicy():
     except:
         print('error deleting bootstrap policy')
 
-    for fileobject in items['Contents']:
-        s3Delete(bucket, fileobject['Key'])
+    s3DeleteKeys(bucket, keys)
 
     try:
         iotClient.delete_provisioning_template(
@@ -135,73 +211,174 @@ def clearBootstrapPolicy():
         print('error deleting provisioning template')
 
 
-def clearThings():
+def limited(api):
+    apiLimiters[api].acquire()
+
+
+def deleteThingPrincipal(thing, principal):
+    certificateId = principal.split('/')[1]
     try:
-        things = iotClient.list_things_in_thing_group(
-            thingGroupName=resourceTag,
+        limited('ListAttachedPolicies')
+        policies = iotClient.list_attached_policies(
+            target=principal
         )
-        for thing in things['things']:
-            cert = iotClient.list_thing_principals(
-                thingName=thing
-            )
-            for principal in cert['principals']:
-                certificateId = principal.split('/')[1]
-                try:
-                    policies = iotClient.list_attached_policies(
-                        target=principal
-                    )
-                    for policy in policies['policies']:
-                        try:
-                            iotClient.detach_policy(
-                                policyName=policy['policyName'],
-                                target=principal
-                            )
-                        except:
-                            print('error detching policy: {} from certificate: {}'.format(
-                                policy['policyName'], certificateId))
-                        try:
-                            iotClient.delete_policy(
-                                policyName=policy['policyName']
-                            )
-                        except:
-                            print('error deleting policy: {}'.format(
-                                policy['policyName']))
-                except:
-                    print('error clearing policies')
-
-                try:
-                    iotClient.detach_thing_principal(
-                        thingName=thing,
-                        principal=principal
-                    )
-                except:
-                    print(
-                        'error detching certificate: {} from thing: {}'.format(certificateId, thing))
-                try:
-                    response = iotClient.update_certificate(
-                        certificateId=certificateId,
-                        newStatus='INACTIVE'
-                    )
-                except:
-                    print('error inactivating certificate: {}'.format(certificateId))
-                try:
-                    iotClient.delete_certificate(
-                        certificateId=certificateId,
-                        forceDelete=True
-                    )
-                except:
-                    print('error deleting certificate: {}'.format(certificateId))
+        for policy in policies['policies']:
+            try:
+                limited('DetachPolicy')
+                iotClient.detach_policy(
+                    policyName=policy['policyName'],
+                    target=principal
+                )
+            except:
+                print('error detching policy: {} from certificate: {}'.format(
+                    policy['policyName'], certificateId))
             try:
-                iotClient.delete_thing(
-                    thingName=thing,
+                limited('DeletePolicy')
+                iotClient.delete_policy(
+                    policyName=policy['policyName']
                 )
             except:
-                print('error deleting thing: {}'.format(thing))
+                print('error deleting policy: {}'.format(
+                    policy['policyName']))
+    except:
+        print('error clearing policies')
+
+    try:
+        limited('DetachThingPrincipal')
+        iotClient.detach_thing_principal(
+            thingName=thing,
+            principal=principal
+        )
+    except:
+        print(
+            'error detching certificate: {} from thing: {}'.format(certificateId, thing))
+    try:
+        limited('UpdateCertificate')
+        iotClient.update_certificate(
+            certificateId=certificateId,
+            newStatus='INACTIVE'
+        )
+    except:
+        print('error inactivating certificate: {}'.format(certificateId))
+    try:
+        limited('DeleteCertificate')
+        iotClient.delete_certificate(
+            certificateId=certificateId,
+            forceDelete=True
+        )
+    except:
+        print('error deleting certificate: {}'.format(certificateId))
+
+
+def deleteThing(thing):
+    try:
+        limited('ListThingPrincipals')
+        paginator = iotClient.get_paginator('list_thing_principals')
+        for page in paginator.paginate(thingName=thing):
+            for principal in page['principals']:
+                deleteThingPrincipal(thing, principal)
+    except:
+        print('error listing principals of thing: {}'.format(thing))
+        return False
+    try:
+        limited('DeleteThing')
+        iotClient.delete_thing(
+            thingName=thing,
+        )
+        return True
+    except:
+        print('error deleting thing: {}'.format(thing))
+        return False
+
+
+def listThings():
+    things = []
+    try:
+        paginator = iotClient.get_paginator('list_things_in_thing_group')
+        for page in paginator.paginate(thingGroupName=resourceTag, PaginationConfig={'PageSize': 250}):
+            things.extend(page['things'])
+    except iotClient.exceptions.ResourceNotFoundException:
+        pass
+    return things
+
+
+def nearDeadline(context):
+    return context.get_remaining_time_in_millis() < teardownMarginMillis
+
+
+def clearThings(context, checkpoint):
+    """Deletes every thing in the project thing group with its certificates
+    and policies. Returns False if the Lambda deadline was reached first."""
+    while True:
+        things = listThings()
+        if not things:
+            break
+        started = time.time()
+        deleted = 0
+        slots = threading.BoundedSemaphore(teardownWorkers * 2)
+        futures = []
+        with ThreadPoolExecutor(max_workers=teardownWorkers) as executor:
+            for thing in things:
+                if nearDeadline(context):
+                    break
+                slots.acquire()
+                future = executor.submit(deleteThing, thing)
+                future.add_done_callback(lambda f: slots.release())
+                futures.append(future)
+        deleted = sum(1 for future in futures if future.result())
+        checkpoint['thingsDeleted'] = checkpoint.get('thingsDeleted', 0) + deleted
+        print('deleted {} of {} things in {:.1f}s'.format(
+            deleted, len(things), time.time() - started))
+        if nearDeadline(context):
+            return False
+        if deleted == 0:
+            checkpoint['idlePasses'] = checkpoint.get('idlePasses', 0) + 1
+            if checkpoint['idlePasses'] >= teardownMaxIdlePasses:
+                raise Exception('could not delete {} things: {}'.format(
+                    len(things), things[:20]))
+
+    try:
         iotClient.delete_thing_group(
             thingGroupName=resourceTag
         )
     except:
-        print('error deleting things')
+        print('error deleting thing group')
+    return True
+
+
+def continueTeardown(event, context):
+    """Re-invokes this function asynchronously with the checkpoint carried in
+    the event so teardown can outlive a single invocation."""
+    lambdaClient.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(event)
+    )
+
+
+def teardown(event, context):
+    """Returns True once every resource is gone, or False if the teardown was
+    handed over to a new invocation that will respond to CloudFormation."""
+    invocationStarted = time.time()
+    checkpoint = event.setdefault(
+        teardownCheckpoint, {'phase': 'resources', 'invocation': 0,
+                             'started': invocationStarted})
+    checkpoint['invocation'] = checkpoint['invocation'] + 1
+    if checkpoint['phase'] == 'resources':
+        clearBootstrapPolicy()
+        clearActivations()
+        clearRegistrations()
+        checkpoint['phase'] = 'things'
+    if clearThings(context, checkpoint):
+        return True
+    # Another invocation of the same length must still fit in the budget.
+    now = time.time()
+    if now - checkpoint['started'] + (now - invocationStarted) > teardownBudgetSeconds:
+        raise Exception('teardown did not finish in {} invocations ({:.0f}s)'.format(
+            checkpoint['invocation'], now - checkpoint['started']))
+    print('continuing teardown: {}'.format(checkpoint))
+    continueTeardown(event, context)
+    return False
 
 
 def getIoTEndpoint():
@@ -224,19 +401,134 @@ def updateConfig(fullPath, filename, iotEndpoint):
     return data
 
 
+def clientEntries(certificates, iotEndpoint, device=None):
+    configPath = '{}/{}'.format(clientDir, configName)
+    entries = [
+        (configName, updateConfig(configPath, configName, iotEndpoint), 0o644),
+        (claimCertPath, certificates['certificatePem'], 0o644),
+        (certKeyPath, certificates['keyPair']['PrivateKey'], 0o600)
+    ]
+    if device:
+        machineConfig = {
+            'device_id': device['device_id'],
+            'model_type': device['model_type']
+        }
+        entries.append((machineConfigName, json.dumps(
+            machineConfig, indent=4), 0o644))
+    return entries
+
+
 def createClient(certificates, iotEndpoint):
-    mem_zip = BytesIO()
+    basePath = bundle_builder.buildBaseArchive(
+        clientDir, renderedFiles, s3Client, bucket)
+    with S3MultipartWriter(s3Client, bucket, clientKey) as client:
+        bundle_builder.writeBundle(
+            client, basePath, clientEntries(certificates, iotEndpoint))
+
+
+def loadClaimCertificates():
+    """The bootstrap claim certificate and key only exist inside client.zip,
+    so factory bundles take them from there."""
+    path = os.path.join(tempfile.gettempdir(), clientKey)
+    s3Client.download_file(bucket, clientKey, path)
+    with ZipFile(path) as client:
+        return {
+            'certificatePem': client.read(claimCertPath).decode('utf-8'),
+            'keyPair': {'PrivateKey': client.read(certKeyPath).decode('utf-8')}
+        }
+
 
-    with ZipFile(mem_zip, mode="w", compression=ZIP_DEFLATED) as client:
-        for root, subFolder, files in os.walk(clientDir):
-            for file in files:
-                fullPath = root + '/' + file
-                data = updateConfig(fullPath, file, iotEndpoint)
-                client.writestr(fullPath.split('client/')[1], data)
-        client.writestr(claimCertPath, certificates['certificatePem'])
-        client.writestr(certKeyPath, certificates['keyPair']['PrivateKey'])
-    mem_zip.seek(0)
-    return mem_zip
+def readFactoryDevices(event):
+    if 'devices' in event:
+        for device in event['devices']:
+            yield device
+        return
+    body = s3Client.get_object(Bucket=bucket, Key=event['devices_key'])['Body']
+    lines = (line.decode('utf-8') for line in body.iter_lines())
+    for row in csv.DictReader(lines):
+        yield {'device_id': row['device_id'].strip(),
+               'model_type': row['model_type'].strip()}
+
+
+def buildDeviceBundle(basePath, certificates, iotEndpoint, device):
+    bundle = BytesIO()
+    bundle_builder.writeBundle(
+        bundle, basePath, clientEntries(certificates, iotEndpoint, device))
+    return bundle.getvalue()
+
+
+def createFactoryBundles(event):
+    """Builds one client bundle per device with machine_config.json filled in,
+    either as entries of one archive per batch or as one object per device,
+    plus a manifest."""
+    batchId = event['batch_id']
+    perDevice = event.get('output', 'archive') == 'objects'
+    batchPrefix = '{}/{}'.format(factoryPrefix, batchId)
+    archiveKey = '{}/bundles.zip'.format(batchPrefix)
+
+    certificates = loadClaimCertificates()
+    iotEndpoint = getIoTEndpoint()
+    basePath = bundle_builder.buildBaseArchive(
+        clientDir, factoryRenderedFiles, s3Client, bucket)
+    manifest = []
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(factoryWorkers * 2)
+    started = time.time()
+
+    writer = None if perDevice else S3MultipartWriter(s3Client, bucket, archiveKey)
+    archive = ZipFile(writer, mode='w') if writer else None
+
+    def build(device):
+        try:
+            data = buildDeviceBundle(
+                basePath, certificates, iotEndpoint, device)
+            name = '{}.zip'.format(device['device_id'])
+            if perDevice:
+                location = '{}/{}'.format(batchPrefix, name)
+                s3Put(bucket, location, data)
+            else:
+                # Bundles are already deflated; store them as is.
+                location = '{}#{}'.format(archiveKey, name)
+                with lock:
+                    archive.writestr(bundle_builder.zipInfo(
+                        name, 0o644, ZIP_STORED), data)
+            entry = dict(device, key=location, size=len(data),
+                         sha256=hashlib.sha256(data).hexdigest())
+        except Exception as e:
+            entry = dict(device, error=str(e))
+        finally:
+            slots.release()
+        with lock:
+            manifest.append(entry)
+
+    try:
+        with ThreadPoolExecutor(max_workers=factoryWorkers) as executor:
+            for device in readFactoryDevices(event):
+                slots.acquire()
+                executor.submit(build, device)
+        if archive:
+            archive.close()
+            writer.close()
+    except Exception:
+        if writer:
+            writer.abort()
+        raise
+
+    failed = [entry for entry in manifest if 'error' in entry]
+    manifestKey = '{}/manifest.json'.format(batchPrefix)
+    s3Put(bucket, manifestKey, json.dumps(
+        sorted(manifest, key=lambda entry: entry['device_id']), indent=1))
+    summary = {
+        'batch_id': batchId,
+        'bundles': len(manifest) - len(failed),
+        'failed': len(failed),
+        'manifest': manifestKey,
+        'seconds': round(time.time() - started, 1)
+    }
+    if not perDevice:
+        summary['archive'] = archiveKey
+    print(summary)
+    return summary
 
 
 def createBootstrapPolicy():
@@ -264,10 +556,9 @@ def createBootstrapPolicy():
     return certificates
 
 
-def uploadClientToS3(certificates, client):
+def uploadBootstrapId(certificates):
     Id = certificates['certificateId']
     s3Put(bucket, "{}/{}.id".format(bootstrapPrefix, Id), Id)
-    s3UploadFileObject(client, 'client.zip')
 
 
 def createTemplateBody():
@@ -307,6 +598,11 @@ def createThingGroup():
         print('error creating thing group')
 
 
+def factoryHandler(event, context):
+    print(event)
+    return createFactoryBundles(event)
+
+
 def handler(event, context):
     responseData = {}
     print(event)
@@ -318,9 +614,8 @@ def handler(event, context):
             createThingGroup()
             iotEndpoint = getIoTEndpoint()
             print('iotendpoint')
-            client = createClient(certificates, iotEndpoint)
-            print('client created')
-            uploadClientToS3(certificates, client)
+            uploadBootstrapId(certificates)
+            createClient(certificates, iotEndpoint)
             print('client uploaded')
             templateBody = createTemplateBody()
             createTemplate(templateBody)
@@ -329,10 +624,8 @@ def handler(event, context):
         elif event['RequestType'] == 'Update':
             result = cfnresponse.SUCCESS
         else:
-            clearBootstrapPolicy()
-            clearActivations()
-            clearRegistrations()
-            clearThings()
+            if not teardown(event, context):
+                return
             result = cfnresponse.SUCCESS
 
     except Exception as e:
@@ -0,0 +1,204 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+# Builds edge client bundles from a cached base archive of the static client
+# files. The base archive is reproducible (sorted entries, fixed timestamps and
+# permissions) and named after a hash of its content, so it is only rebuilt
+# when the client code changes. Lambda's /tmp rarely outlives a deployment, so
+# the archive is also cached in the bundle bucket under the same name and
+# reused by every later stack operation and factory batch. A bundle is the base archive's entries copied
+# byte for byte, followed by the per-bundle entries (rendered config, certs),
+# streamed straight to an S3 multipart upload.
+# ------------------------------------------------------------------------------
+
+import hashlib
+import os
+import stat
+import tempfile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+excludedNames = {'.DS_Store', 'Thumbs.db'}
+excludedDirs = {'__pycache__', '.pytest_cache'}
+excludedSuffixes = ('.pyc', '.pyo')
+fixedDateTime = (1980, 1, 1, 0, 0, 0)
+copyChunkSize = 1024 * 1024
+partSize = 8 * 1024 * 1024
+cachePrefix = 'cache'
+
+
+def staticFiles(clientDir, renderedFiles):
+    """Sorted (archive name, path) pairs for the client files that are the
+    same in every bundle."""
+    files = []
+    for root, dirs, names in os.walk(clientDir):
+        dirs[:] = [name for name in dirs if name not in excludedDirs]
+        for name in names:
+            if name in excludedNames or name.endswith(excludedSuffixes):
+                continue
+            fullPath = os.path.join(root, name)
+            arcname = os.path.relpath(fullPath, clientDir).replace(os.sep, '/')
+            if arcname in renderedFiles:
+                continue
+            files.append((arcname, fullPath))
+    return sorted(files)
+
+
+def fileMode(path):
+    return 0o755 if os.stat(path).st_mode & stat.S_IXUSR else 0o644
+
+
+def contentDigest(files):
+    digest = hashlib.sha256()
+    for arcname, fullPath in files:
+        digest.update(arcname.encode('utf-8') + b'\0')
+        digest.update(str(fileMode(fullPath)).encode('utf-8') + b'\0')
+        with open(fullPath, 'rb') as fileReference:
+            digest.update(hashlib.sha256(fileReference.read()).digest())
+    return digest.hexdigest()
+
+
+def zipInfo(arcname, mode, compressType=ZIP_DEFLATED):
+    info = ZipInfo(arcname, date_time=fixedDateTime)
+    info.compress_type = compressType
+    info.create_system = 3
+    info.external_attr = (stat.S_IFREG | mode) << 16
+    return info
+
+
+def buildBaseArchive(clientDir, renderedFiles, s3Client=None, bucket=None,
+                     cacheDir=None):
+    """Returns the path of the base archive for the current client files,
+    building it only if no archive with the same content hash exists locally
+    or under cachePrefix in bucket."""
+    cacheDir = cacheDir or tempfile.gettempdir()
+    files = staticFiles(clientDir, renderedFiles)
+    name = 'client-base-{}.zip'.format(contentDigest(files)[:16])
+    path = os.path.join(cacheDir, name)
+    if os.path.exists(path):
+        return path
+    key = '{}/{}'.format(cachePrefix, name)
+    tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+
+    if s3Client:
+        try:
+            s3Client.download_file(bucket, key, tmpPath)
+            os.replace(tmpPath, path)
+            return path
+        except Exception as e:
+            print('base archive {} not cached: {}'.format(key, e))
+
+    with ZipFile(tmpPath, mode='w') as base:
+        for arcname, fullPath in files:
+            with open(fullPath, 'rb') as fileReference:
+                base.writestr(zipInfo(arcname, fileMode(fullPath)),
+                              fileReference.read())
+    os.replace(tmpPath, path)
+    if s3Client:
+        try:
+            s3Client.upload_file(path, bucket, key)
+        except Exception as e:
+            print('error caching base archive {}: {}'.format(key, e))
+    return path
+
+
+def writeBundle(fileobj, basePath, entries):
+    """Writes a zip to fileobj made of the base archive's entries followed by
+    entries, a list of (archive name, data, mode). fileobj only needs write,
+    tell and flush."""
+    with ZipFile(basePath) as base:
+        baseInfos = base.infolist()
+        baseLength = base.start_dir
+
+    # Local headers and compressed data of the base entries are copied as is;
+    # only the central directory is rewritten below.
+    with open(basePath, 'rb') as baseFile:
+        remaining = baseLength
+        while remaining:
+            chunk = baseFile.read(min(copyChunkSize, remaining))
+            fileobj.write(chunk)
+            remaining -= len(chunk)
+
+    with ZipFile(fileobj, mode='w') as bundle:
+        for info in baseInfos:
+            bundle.filelist.append(info)
+            bundle.NameToInfo[info.filename] = info
+        for arcname, data, mode in entries:
+            bundle.writestr(zipInfo(arcname, mode), data)
+
+
+class S3MultipartWriter:
+    """Write-only, non-seekable file object uploading to S3 in parts so a
+    bundle is never held in memory as a whole."""
+
+    def __init__(self, s3Client, bucket, key):
+        self.s3Client = s3Client
+        self.bucket = bucket
+        self.key = key
+        self.buffer = bytearray()
+        self.parts = []
+        self.position = 0
+        self.uploadId = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position += len(data)
+        if len(self.buffer) >= partSize:
+            self.uploadPart()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, *args):
+        raise OSError('S3MultipartWriter is not seekable')
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def uploadPart(self):
+        if self.uploadId is None:
+            self.uploadId = self.s3Client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+        response = self.s3Client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.uploadId,
+            PartNumber=len(self.parts) + 1,
+            Body=bytes(self.buffer)
+        )
+        self.parts.append({'ETag': response['ETag'],
+                           'PartNumber': len(self.parts) + 1})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.uploadId is None:
+            # Smaller than one part: a single PutObject is enough.
+            self.s3Client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            return
+        if self.buffer:
+            self.uploadPart()
+        self.s3Client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.uploadId,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        if self.uploadId is not None:
+            self.s3Client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.uploadId)
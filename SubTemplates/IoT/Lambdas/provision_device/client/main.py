@@ -25,18 +25,24 @@
 
 from __future__ import absolute_import
 from __future__ import print_function
-import AWSIoTPythonSDK
-from awscrt import io, mqtt, auth, http
+from awscrt import io, mqtt
 from awsiot import mqtt_connection_builder
+import asyncio
+import calendar
 import json
 import os
-from provisioning_handler import ProvisioningHandler
 import subprocess
 import sys
+import threading
 import time
-import traceback
-import types
+from utils.command_executor import CommandExecutor
+from utils.command_router import CommandRouter
 from utils.config_loader import Config
+from utils.credential_store import CredentialStore
+from utils.idempotency_store import IdempotencyStore
+from utils.offline_queue import OfflineQueue, QueuedPublisher
+from utils.reconnect import ReconnectController
+from utils.runtime import AgentRuntime
 
 certs = {
     'cert': '',
@@ -45,23 +51,51 @@ certs = {
 }
 
 CONFIG_PATH = 'config.ini'
-config = Config(CONFIG_PATH)
-config_parameters = config.get_section('SETTINGS')
-iot_endpoint = config_parameters['IOT_ENDPOINT']
-region = config_parameters['REGION']
-secure_cert_path = config_parameters['SECURE_CERT_PATH']
-bootstrap_claim_cert = config_parameters['BOOTSTRAP_CLAIM_CERT']
-bootstrap_secure_key = config_parameters['BOOTSTRAP_SECURE_KEY']
-root_cert = config_parameters['ROOT_CERT']
-machine_config = config_parameters['MACHINE_CONFIG_PATH']
-
-with open(machine_config) as json_file:
-    data = json.load(json_file)
-    device_id = data['device_id']
-    model_type = data['model_type']
-
-topicSSMActivate = 'cmd/{}/ssm/activate'.format(device_id)
-topicSSMDeactivate = 'cmd/{}/ssm/deactivate'.format(device_id)
+
+
+def loadSettings(config_path=CONFIG_PATH):
+    # Parsed on start rather than at import so importing this module (e.g. from
+    # the startup benchmark) costs nothing beyond the imports themselves.
+    global config_parameters, iot_endpoint, region, secure_cert_path, bootstrap_claim_cert, \
+        bootstrap_secure_key, root_cert, device_id, model_type, \
+        topicCommands, topicSSMStatus, topicDiagnostics, offlineQueueSettings, \
+        reconnectSettings, enableDiagnostics, idempotencySettings
+    config = Config(config_path)
+    config_parameters = config.get_section('SETTINGS')
+    iot_endpoint = config_parameters['IOT_ENDPOINT']
+    region = config_parameters['REGION']
+    secure_cert_path = config_parameters['SECURE_CERT_PATH']
+    bootstrap_claim_cert = config_parameters['BOOTSTRAP_CLAIM_CERT']
+    bootstrap_secure_key = config_parameters['BOOTSTRAP_SECURE_KEY']
+    root_cert = config_parameters['ROOT_CERT']
+    machine_config = config_parameters['MACHINE_CONFIG_PATH']
+    offlineQueueSettings = {
+        'directory': config_parameters.get('OFFLINE_QUEUE_PATH', './offline_queue'),
+        'max_messages': int(config_parameters.get('OFFLINE_QUEUE_MAX_MESSAGES', 1000)),
+        'max_bytes': int(config_parameters.get('OFFLINE_QUEUE_MAX_BYTES', 1024 * 1024)),
+        'policy': config_parameters.get('OFFLINE_QUEUE_POLICY', 'drop-oldest')
+    }
+    idempotencySettings = {
+        'path': config_parameters.get('IDEMPOTENCY_STORE_PATH', './command_ids.log'),
+        'max_entries': int(config_parameters.get('IDEMPOTENCY_MAX_ENTRIES', 1000))
+    }
+    reconnectSettings = {
+        'min_backoff': int(config_parameters.get('RECONNECT_MIN_BACKOFF', 1)),
+        'max_backoff': int(config_parameters.get('RECONNECT_MAX_BACKOFF', 128)),
+        'jitter': float(config_parameters.get('RECONNECT_JITTER', 5))
+    }
+
+    with open(machine_config) as json_file:
+        data = json.load(json_file)
+        device_id = data['device_id']
+        model_type = data['model_type']
+
+    # Commands arrive on cmd/<device_id>/<command>, e.g. cmd/<device_id>/ssm/activate
+    topicCommands = 'cmd/{}'.format(device_id)
+    topicSSMStatus = 'dt/{}/ssm/status'.format(device_id)
+    topicDiagnostics = 'dt/{}/diagnostics'.format(device_id)
+    enableDiagnostics = config_parameters.get('ENABLE_DIAGNOSTICS', 'False').lower() == 'true'
+
 
 myOs = os.name
 
@@ -70,7 +104,7 @@ mac = 'java'
 windows = 'nt'
 
 installOptions = {}
-installOptions[linux] = os.path.abspath('ssmScripts/installSsm.sh')
+installOptions[linux] = os.path.abspath('ssmScripts/installSsm.py')
 installOptions[windows] = os.path.abspath('ssmScripts/installSsm.ps1')
 
 uninstallOptions = {}
@@ -132,31 +166,66 @@ def elevateToAdminIfWindows():
         unblock(uninstallScript)
 
 
-def on_connection_interrupted(connection, error, **kwargs):
-    print("Connection interrupted. error: {}".format(error))
-
-
-# Callback when an interrupted connection is re-established.
-def on_connection_resumed(connection, return_code, session_present, **kwargs):
-    print("Connection resumed. return_code: {} session_present: {}".format(
-        return_code, session_present))
-
-    if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
-        print("Session did not persist. Resubscribing to existing topics...")
-        resubscribe_future, _ = connection.resubscribe_existing_topics()
-
-        # Cannot synchronously wait for resubscribe result because we're on the connection's event-loop thread,
-        # evaluate result with a callback instead.
-        resubscribe_future.add_done_callback(on_resubscribe_complete)
-
-
-def on_resubscribe_complete(resubscribe_future):
-    resubscribe_results = resubscribe_future.result()
-    print("Resubscribe results: {}".format(resubscribe_results))
-
-    for topic, qos in resubscribe_results['topics']:
-        if qos is None:
-            sys.exit("Server rejected resubscribe to topic: {}".format(topic))
+def on_connection_change(online):
+    if online:
+        print('Offline queue: {}'.format(statusPublisher.queue.metrics()))
+    statusPublisher.set_online(online)
+
+
+# Reconnect backoff, resubscribe after a lost session and reconnect metrics.
+reconnectController = None
+
+
+# Install/uninstall commands run on the executor's worker thread, never on the
+# connection's event-loop thread, so a long install cannot stall keep alives.
+commandExecutor = None
+# Status messages (command replies included) go through a bounded on-disk
+# queue so they survive disconnects and reboots without growing memory.
+statusPublisher = None
+# Routes cmd/<device_id>/# messages to the handlers registered in runSSMOnDemand.
+commandRouter = None
+# Ids of handled commands, so QoS1 redeliveries (also after a restart) are dropped.
+commandIds = None
+# How long a deactivate messageId is remembered, as long as an activation lives.
+commandIdLifetime = 2 * 24 * 3600
+# Command id of each submitted job, settled in commandIds once the job ends.
+# Re-entrant: submit reports 'queued' through publishStatus on the same thread.
+commandJobs = {}
+commandJobsLock = threading.RLock()
+
+
+def activationExpiry(data):
+    # expirationDate is written by ToggleSSMFunction in UTC.
+    try:
+        return calendar.timegm(time.strptime(
+            data['expirationDate'], "%m/%d/%Y, %H:%M:%S"))
+    except (KeyError, ValueError):
+        return time.time() + commandIdLifetime
+
+
+def submitCommand(name, command, key):
+    with commandJobsLock:
+        job_id = commandExecutor.submit(name, command)
+        if key is None:
+            return
+        if job_id is None:
+            commandIds.discard(key)
+        else:
+            commandJobs[job_id] = key
+
+
+def settleCommand(status):
+    with commandJobsLock:
+        if status['state'] not in ('succeeded', 'failed', 'timeout', 'cancelled'):
+            return
+        key = commandJobs.pop(status.get('job_id'), None)
+    if key is None:
+        return
+    # A redelivery of a command that did not succeed runs it again.
+    if status['state'] == 'succeeded':
+        commandIds.finish(key)
+    else:
+        commandIds.discard(key)
 
 
 # Callback for ssm activate message
@@ -166,110 +235,200 @@ def on_ssm_activate(topic, payload, **kwargs):
     data = json.loads(payload)
     code = data['activationCode']
     id = data['activationId']
+    key = 'activate:' + id
+    if not commandIds.check_and_add(key, activationExpiry(data)):
+        print('Dropping duplicate activation {}'.format(id))
+        return
 
     if myOs == windows:
         command = 'powershell.exe {} {} {} {} -Verb "runAs"'.format(
             installScript, code, id, region)
-        subprocess.Popen(command)
     if myOs == linux:
-        os.system("chmod u+rx {}".format(installScript))
-        subprocess.check_call([installScript, code, id, region])
+        command = [sys.executable, installScript, code, id, region]
+    submitCommand('activate', command, key)
 # Callback for ssm deactivate message
 
 
 def on_ssm_uninstall(topic, payload, **kwargs):
     print("Received message from topic '{}': {}".format(topic, payload))
     print('uninstall ssm')
-
+    data = json.loads(payload)
+    # Deactivations published before messageId was added cannot be de-duplicated.
+    key = 'deactivate:' + data['messageId'] if 'messageId' in data else None
+    if key and not commandIds.check_and_add(key, time.time() + commandIdLifetime):
+        print('Dropping duplicate deactivation {}'.format(data['messageId']))
+        return
+
+    # An install still queued or running is superseded by the uninstall.
+    commandExecutor.cancel('activate')
     if myOs == windows:
         command = 'powershell.exe {} -Verb "runAs"'.format(uninstallScript)
-        subprocess.Popen(command)
     if myOs == linux:
         os.system("chmod u+rx {}".format(uninstallScript))
-        subprocess.check_call([uninstallScript])
+        command = [uninstallScript]
+    submitCommand('deactivate', command, key)
+
+
+def publishStatus(status):
+    settleCommand(status)
+    statusPublisher.put(topicSSMStatus, json.dumps(status))
+
+
+# Callback for diagnostics message, only registered when ENABLE_DIAGNOSTICS is set
+def on_diagnostics(topic, payload, **kwargs):
+    statusPublisher.put(topicDiagnostics, json.dumps({
+        'device_id': device_id,
+        'commands': commandRouter.stats(),
+        'offline_queue': statusPublisher.queue.metrics(),
+        'connection': reconnectController.metrics()
+    }))
+
+
+def on_command_rejected(command, reason):
+    publishStatus({'command': command, 'state': 'rejected', 'reason': reason})
+
+
+def publishQueued(connection, topic, payload):
+    publish_future, packet_id = connection.publish(
+        topic=topic,
+        payload=payload,
+        qos=mqtt.QoS.AT_LEAST_ONCE)
+    return publish_future
+
+
 # Establishes mqtt connection
+clientBootstrap = None
 
 
-def mqttConnect(certs):
-    event_loop_group = io.EventLoopGroup(1)
-    host_resolver = io.DefaultHostResolver(event_loop_group)
-    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+def buildConnection(cert_path, key_path, client_id, clean_session=False):
+    # Used for the claim and production connections alike, so a freshly
+    # provisioned device keeps the connection validated by the handler.
+    global clientBootstrap
+    if clientBootstrap is None:
+        event_loop_group = io.EventLoopGroup(1)
+        host_resolver = io.DefaultHostResolver(event_loop_group)
+        clientBootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
 
-    connection = mqtt_connection_builder.mtls_from_path(
+    return mqtt_connection_builder.mtls_from_path(
         endpoint=iot_endpoint,
-        cert_filepath=certs['cert'],
-        pri_key_filepath=certs['key'],
-        client_bootstrap=client_bootstrap,
-        ca_filepath=certs['root'],
-        on_connection_interrupted=on_connection_interrupted,
-        on_connection_resumed=on_connection_resumed,
-        client_id=device_id,
-        clean_session=False,
-        keep_alive_secs=6)
-
+        cert_filepath=cert_path,
+        pri_key_filepath=key_path,
+        client_bootstrap=clientBootstrap,
+        ca_filepath='{}/{}'.format(secure_cert_path, root_cert),
+        client_id=client_id,
+        clean_session=clean_session,
+        keep_alive_secs=6,
+        **reconnectController.connection_options())
+
+
+async def mqttConnect(runtime, certs):
+    connection = buildConnection(certs['cert'], certs['key'], device_id)
     print("Connecting to {} with client ID '{}'...".format(
         iot_endpoint, device_id))
-    connect_future = connection.connect()
-    connect_future.result()
+    await runtime.wait(connection.connect())
     print("Connected!")
     return connection
 
+
+async def mqttDisconnect(runtime, connection):
+    print("Disconnecting...")
+    await runtime.wait(connection.disconnect())
+    print("Disconnected!")
+
 # Subscribes to appropriate mqtt topics
 
 
-def subscribe(connection, topic, callback):
+async def subscribe(runtime, connection, topic, callback):
     print("Subscribing to topic '{}'...".format(topic))
     subscribe_future, packet_id = connection.subscribe(
         topic=topic,
         qos=mqtt.QoS.AT_LEAST_ONCE,
         callback=callback)
-    return subscribe_future
-
-
-def startSSMOnDemand(certs):
-    connection = mqttConnect(certs)
+    result = await runtime.wait(subscribe_future)
+    if result['qos'] is None:
+        raise RuntimeError('Server rejected subscribe to topic: {}'.format(topic))
+    print("Subscribed to topic '{}'".format(topic))
+    return result
+
+
+async def runSSMOnDemand(runtime, connection):
+    global commandExecutor, statusPublisher, commandRouter, commandIds
+    commandIds = IdempotencyStore(**idempotencySettings)
+    statusPublisher = QueuedPublisher(
+        OfflineQueue(**offlineQueueSettings),
+        lambda topic, payload: publishQueued(connection, topic, payload))
+    # Anything left from before a reboot is sent first.
+    statusPublisher.start(online=True)
+    runtime.add_shutdown_hook(statusPublisher.stop)
+    reconnectController.add_listener(on_connection_change)
+    commandExecutor = CommandExecutor(publishStatus)
+    commandExecutor.start()
+    runtime.add_shutdown_hook(commandExecutor.stop)
+
+    # One wildcard subscription for every command.
+    commandRouter = CommandRouter(topicCommands, on_rejected=on_command_rejected)
+    commandRouter.register('ssm/activate', on_ssm_activate)
+    commandRouter.register('ssm/deactivate', on_ssm_uninstall)
+    if enableDiagnostics:
+        commandRouter.register('diagnostics', on_diagnostics)
+    commandRouter.start()
+    runtime.add_shutdown_hook(commandRouter.stop)
+    await subscribe(runtime, connection, commandRouter.topic_filter, commandRouter.dispatch)
+
+
+async def fleetProvisioning(runtime):
+    # Only needed on first boot, so not imported by already provisioned devices.
+    from provisioning_handler import ProvisioningHandler, ProvisioningError
 
-    activate = subscribe(connection, topicSSMActivate, on_ssm_activate)
-    deactivate = subscribe(
-        connection, topicSSMDeactivate, on_ssm_uninstall)
-    while True:
-        time.sleep(5)
-
-
-def prodCerts(payload):
-    print(payload)
-    print('callback occured')
-
-    # certs = checkForCerts(certs)
-
-
-def fleetProvisioning():
     # Instantiate provisioning handler, pass in path to config
-    provisioner = ProvisioningHandler(CONFIG_PATH)
+    provisioner = ProvisioningHandler(
+        CONFIG_PATH, connection_factory=buildConnection)
 
-    # Call super-method to perform aquisition/activation
-    # of certs, creation of thing, etc. Returns general
-    # purpose callback at this point.
-    provisioner.get_official_certs(prodCerts)
+    # Perform aquisition/activation of certs, creation of thing, etc.
+    # Returns the connection already validated with the new certificate.
+    try:
+        return await provisioner.provision()
+    except ProvisioningError as e:
+        print('Fleet provisioning failed: {}'.format(e))
+        return None
 
 
 def checkForCerts(certs):
-    for root, dirs, files in os.walk("./certs", topdown=False):
-        for name in files:
-            if name == root_cert:
-                certs['root'] = '{}/{}'.format(secure_cert_path, name)
-            if "-certificate.pem.crt" in name and name != bootstrap_claim_cert:
-                certs['cert'] = '{}/{}'.format(secure_cert_path, name)
-            if '-private.pem.key' in name and name != bootstrap_secure_key:
-                certs['key'] = '{}/{}'.format(secure_cert_path, name)
+    # The manifest names the active credentials; folders from before it
+    # existed are scanned once and migrated.
+    store = CredentialStore(secure_cert_path)
+    entry = store.active() or store.migrate_legacy(
+        bootstrap_claim_cert, bootstrap_secure_key)
+    certs['root'] = '{}/{}'.format(secure_cert_path, root_cert)
+    if entry:
+        certs['cert'] = store.path(entry['cert'])
+        certs['key'] = store.path(entry['key'])
     print(certs)
-    if not certs['key'] or not certs['cert']:
-        fleetProvisioning()  # add logic to only retry once
+    return entry is not None
+
+
+async def startAgent(runtime):
+    global reconnectController
+    reconnectController = ReconnectController(runtime, **reconnectSettings)
+    if checkForCerts(certs):
+        connection = await mqttConnect(runtime, certs)
     else:
-        startSSMOnDemand(certs)
+        connection = await fleetProvisioning(runtime)
+        if connection is None:
+            runtime.stop(exit_code=1)
+            return
+    runtime.add_shutdown_hook(lambda: mqttDisconnect(runtime, connection))
+    await runSSMOnDemand(runtime, connection)
+
+
+def startSSMOnDemand():
+    # Runs until SIGTERM/SIGINT; the event loop sleeps between messages
+    # instead of polling.
+    runtime = AgentRuntime()
+    return asyncio.run(runtime.run(startAgent))
 
 
 if __name__ == "__main__":
+    loadSettings()
     elevateToAdminIfWindows()
-    # Set Config path
-    checkForCerts(certs)
+    sys.exit(startSSMOnDemand())
@@ -10,30 +10,53 @@
 # ------------------------------------------------------------------------------
 
 
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
-import AWSIoTPythonSDK.exception
+from awscrt import io, mqtt
+from awsiot import mqtt_connection_builder
+from utils.backoff import full_jitter, spread
 from utils.config_loader import Config
-import time
+from utils.credential_store import CredentialStore
+from utils.provisioning_journal import ProvisioningJournal
 import logging
 import json
 import os
 import asyncio
-from pyfiglet import Figlet
+import time
 
 
-class ProvisioningHandler:
+class ProvisioningError(Exception):
+    """A provisioning step was rejected or did not answer in time. retryable
+    is False for rejections that will not change on retry (400, 403);
+    token_rejected is True when RegisterThing refused the ownership token."""
+
+    def __init__(self, message, step=None, retryable=True, token_rejected=False):
+        Exception.__init__(self, message)
+        self.step = step
+        self.retryable = retryable
+        self.token_rejected = token_rejected
+
+
+def is_retryable(status_code):
+    """Throttling and service errors are retried; other rejections are not."""
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+def is_token_rejection(error_code, error_message):
+    """RegisterThing refuses an expired or unknown certificate ownership token."""
+    return ('ownershiptoken' in str(error_code or '').lower() or
+            'ownership token' in str(error_message or '').lower())
 
-    def __init__(self, file_path):
-        # Demo Theater
-        f = Figlet(font='slant')
-        print(f.renderText('      F l e e t'))
-        print(f.renderText('Provisioning'))
-        print(f.renderText('----------'))
 
+class ProvisioningHandler:
+
+    def __init__(self, file_path, connection_factory=None, device_id=None, model_type=None):
         """Initializes the provisioning handler
 
         Arguments:
                 file_path {string} -- path to your configuration file
+                connection_factory {callable} -- builds an awscrt mqtt.Connection from
+                        (cert_path, key_path, client_id, clean_session). The device agent passes its
+                        own so the validated production connection is the one it keeps using.
+                device_id, model_type {string} -- override machine_config.json (load testing)
         """
         # Logging
         logging.basicConfig(level=logging.ERROR)
@@ -49,11 +72,21 @@ class ProvisioningHandler:
         self.secure_key = self.config_parameters['BOOTSTRAP_SECURE_KEY']
         self.root_cert = self.config_parameters['ROOT_CERT']
         self.machine_config = self.config_parameters['MACHINE_CONFIG_PATH']
-
-        with open(self.machine_config) as json_file:
-            data = json.load(json_file)
-            self.device_id = data['device_id']
-            self.model_type = data['model_type']
+        self.credential_store = CredentialStore(self.secure_cert_path)
+
+        if self.config_parameters.get('SHOW_BANNER', 'False').lower() == 'true':
+            self.show_banner()
+
+        if device_id is None:
+            with open(self.machine_config) as json_file:
+                data = json.load(json_file)
+                device_id = data['device_id']
+                model_type = data['model_type']
+        self.device_id = device_id
+        self.model_type = model_type
+        # Completed steps survive a reboot so an interrupted flow resumes.
+        self.journal = ProvisioningJournal('{}/provisioning-{}.journal'.format(
+            self.secure_cert_path, self.device_id))
 
         # ------------------------------------------------------------------------------
         #  -- PROVISIONING HOOKS EXAMPLE --
@@ -68,36 +101,103 @@ class ProvisioningHandler:
         # ------------------------------------------------------------------------------
         self.hasValidAccount = True
 
-        self.primary_MQTTClient = AWSIoTMQTTClient("fleet_provisioning_demo")
-
-        self.primary_MQTTClient.onMessage = self.on_message_callback
-        self.callback_returned = False
+        self.connection_factory = connection_factory or self.mtls_connection
+        self.primary_connection = None
+        self.production_connection = None
         self.message_payload = {}
 
-    def core_connect(self):
-        """ Method used to connect to connect to AWS IoTCore Service. Endpoint collected from config.
+        # Each step awaits a future resolved from the MQTT callbacks, which run
+        # on the awscrt event-loop thread, so the asyncio loop idles instead of spinning.
+        self.step_timeout = float(
+            self.config_parameters.get('PROVISIONING_STEP_TIMEOUT', 30))
+        self.loop = None
+        self.pending = {}
+
+        # After a site power outage the whole fleet boots at once; a stable
+        # per device delay and jittered retries turn that spike into a ramp.
+        self.max_attempts = int(self.config_parameters.get('PROVISIONING_MAX_ATTEMPTS', 5))
+        self.backoff_base = float(self.config_parameters.get('PROVISIONING_BACKOFF_BASE', 2))
+        self.backoff_max = float(self.config_parameters.get('PROVISIONING_BACKOFF_MAX', 120))
+        self.startup_spread = float(
+            self.config_parameters.get('PROVISIONING_STARTUP_SPREAD', 30))
+        # Retries per failed step, e.g. {'create_keys': 2}.
+        self.retries = {}
+        # Seconds spent in each connection and provisioning step.
+        self.timings = {}
+
+    def show_banner(self):
+        # Demo Theater. pyfiglet is optional and only imported when enabled.
+        try:
+            from pyfiglet import Figlet
+        except ImportError:
+            print('##### FLEET PROVISIONING #####')
+            return
+        f = Figlet(font='slant')
+        print(f.renderText('      F l e e t'))
+        print(f.renderText('Provisioning'))
+        print(f.renderText('----------'))
 
+    def mtls_connection(self, cert_path, key_path, client_id, clean_session=True):
+        """ Default connection factory: a mutual TLS connection to the IoT endpoint from config.
         """
-        self.primary_MQTTClient.configureEndpoint(self.iot_endpoint, 8883)
-        self.primary_MQTTClient.configureCredentials("{}/{}".format(self.secure_cert_path,
-                                                                    self.root_cert), "{}/{}".format(self.secure_cert_path, self.secure_key),
-                                                     "{}/{}".format(self.secure_cert_path, self.claim_cert))
-        self.primary_MQTTClient.configureOfflinePublishQueueing(-1)
-        self.primary_MQTTClient.configureDrainingFrequency(2)
-        self.primary_MQTTClient.configureConnectDisconnectTimeout(10)
-        self.primary_MQTTClient.configureMQTTOperationTimeout(3)
+        event_loop_group = io.EventLoopGroup(1)
+        host_resolver = io.DefaultHostResolver(event_loop_group)
+        client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+        return mqtt_connection_builder.mtls_from_path(
+            endpoint=self.iot_endpoint,
+            cert_filepath=cert_path,
+            pri_key_filepath=key_path,
+            client_bootstrap=client_bootstrap,
+            ca_filepath="{}/{}".format(self.secure_cert_path, self.root_cert),
+            client_id=client_id,
+            clean_session=clean_session,
+            keep_alive_secs=30)
+
+    async def wait(self, future):
+        return await asyncio.wrap_future(future)
+
+    async def subscribe(self, connection, topic, callback):
+        subscribe_future, _ = connection.subscribe(
+            topic=topic, qos=mqtt.QoS.AT_LEAST_ONCE, callback=callback)
+        result = await self.wait(subscribe_future)
+        if result['qos'] is None:
+            raise ProvisioningError('Subscribe to {} rejected'.format(topic), 'subscribe')
+
+    def publish(self, connection, topic, payload):
+        connection.publish(topic=topic, payload=payload,
+                           qos=mqtt.QoS.AT_LEAST_ONCE)
+
+    async def core_connect(self):
+        """ Method used to connect to connect to AWS IoTCore Service. Endpoint collected from config.
 
+        """
         self.logger.info('##### CONNECTING WITH PROVISIONING CLAIM CERT #####')
         print('##### CONNECTING WITH PROVISIONING CLAIM CERT #####')
-        self.primary_MQTTClient.connect()
-
-    def enable_error_monitor(self):
+        self.primary_connection = self.connection_factory(
+            "{}/{}".format(self.secure_cert_path, self.claim_cert),
+            "{}/{}".format(self.secure_cert_path, self.secure_key),
+            self.device_id, clean_session=True)
+        start = time.monotonic()
+        await self.wait(self.primary_connection.connect())
+        self.timings['claim_connect'] = time.monotonic() - start
+
+    async def enable_error_monitor(self):
         """ Subscribe to pertinent IoTCore topics that would emit errors
         """
-        self.primary_MQTTClient.subscribe("$aws/provisioning-templates/{}/provision/json/rejected".format(
-            self.template_name), 1, callback=self.basic_callback)
-        self.primary_MQTTClient.subscribe(
-            "$aws/certificates/create/json/rejected", 1, callback=self.basic_callback)
+        await asyncio.gather(
+            self.subscribe(self.primary_connection, "$aws/provisioning-templates/{}/provision/json/rejected".format(
+                self.template_name), self.rejected_callback),
+            self.subscribe(self.primary_connection,
+                           "$aws/certificates/create/json/rejected", self.rejected_callback))
+
+    async def enable_response_monitor(self):
+        """ Subscribe to the accepted topics answering each provisioning step
+        """
+        await asyncio.gather(
+            self.subscribe(self.primary_connection, "$aws/provisioning-templates/{}/provision/json/accepted".format(
+                self.template_name), self.on_message_callback),
+            self.subscribe(self.primary_connection,
+                           "$aws/certificates/create/json/accepted", self.on_message_callback))
 
     def get_official_certs(self, callback):
         """ Initiates an async loop/call to kick off the provisioning flow.
@@ -108,47 +208,174 @@ class ProvisioningHandler:
         return asyncio.run(self.orchestrate_provisioning_flow(callback))
 
     async def orchestrate_provisioning_flow(self, callback):
-        # Connect to core with provision claim creds
-        self.core_connect()
-
-        # Monitor topics for errors
-        self.enable_error_monitor()
-
-        # Make a publish call to topic to get official certs
-        self.primary_MQTTClient.publish(
-            "$aws/certificates/create/json", "{}", 0)
-
-        # Wait the function return until all callbacks have returned
-        # Returned denoted when callback flag is set in this class.
-        while not self.callback_returned:
-            await asyncio.sleep(0)
+        connection = await self.provision()
+        try:
+            return callback(self.message_payload)
+        finally:
+            await self.wait(connection.disconnect())
 
-        return callback(self.message_payload)
+    async def provision(self):
+        """ Runs the whole flow and returns the connected production connection,
+        already tested with the new certificate.
+        """
+        self.loop = asyncio.get_running_loop()
+        delay = spread(self.device_id, self.startup_spread)
+        if delay:
+            print('##### STARTING PROVISIONING IN {:.1f}s #####'.format(delay))
+            await asyncio.sleep(delay)
+
+        for attempt in range(self.max_attempts):
+            try:
+                return await self.provision_attempt()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                step = getattr(e, 'step', None) or 'connect'
+                retryable = getattr(e, 'retryable', True)
+                if not retryable or attempt + 1 == self.max_attempts:
+                    if isinstance(e, ProvisioningError):
+                        raise
+                    raise ProvisioningError('{} failed: {}'.format(step, e), step) from e
+                self.retries[step] = self.retries.get(step, 0) + 1
+                delay = full_jitter(attempt, self.backoff_base, self.backoff_max)
+                print('##### {} FAILED ({}), RETRYING IN {:.1f}s #####'.format(
+                    step.upper(), e, delay))
+                await asyncio.sleep(delay)
+
+    async def provision_attempt(self):
+        resumed = self.resume()
+        if resumed not in ('thing_registered', 'cert_validated'):
+            await self.claim_certificate(resumed)
+        await self.rotate_certs()
+        return self.production_connection
+
+    def resume(self):
+        """Restores the credentials of an interrupted attempt from the journal,
+        returning the last completed step (None to start from scratch).
+        """
+        resumed = self.journal.begin()
+        if resumed is None:
+            return None
+        keys = self.journal.get('keys_received')
+        if not self.credential_store.verify(keys['credentials']):
+            print('##### SAVED KEYS MISSING OR DAMAGED, STARTING OVER #####')
+            self.journal.reset()
+            return None
+        self.new_credentials = keys['credentials']
+        self.new_cert_name = self.new_credentials['cert']
+        self.new_key_name = self.new_credentials['key']
+        self.ownership_token = keys['ownership_token']
+        print('##### RESUMING PROVISIONING AFTER {} #####'.format(resumed.upper()))
+        return resumed
+
+    async def claim_certificate(self, resumed):
+        """Uses the claim certificate to get a new certificate (unless one was
+        received before a restart) and register the thing with it.
+        """
+        # Connect to core with provision claim creds
+        await self.core_connect()
+        try:
+            # Monitor topics for errors and responses
+            await asyncio.gather(self.enable_error_monitor(),
+                                 self.enable_response_monitor())
+
+            if resumed is None:
+                # Make a publish call to topic to get official certs
+                keys = await self.run_step('create_keys', lambda: self.publish(
+                    self.primary_connection, "$aws/certificates/create/json", "{}"))
+                self.logger.info('##### SUCCESS. SAVING KEYS TO DEVICE! #####')
+                print('##### SUCCESS. SAVING KEYS TO DEVICE! #####')
+                self.assemble_certificates(keys)
+                self.journal.record('keys_received', credentials=self.new_credentials,
+                                    ownership_token=self.ownership_token)
+
+            # register newly aquired cert
+            try:
+                registration = await self.run_step('register_thing', lambda: self.register_thing(
+                    self.device_id, self.ownership_token))
+            except ProvisioningError as e:
+                if resumed is not None and e.token_rejected:
+                    # The ownership token expired while the device was down;
+                    # the next attempt starts over with new keys. Any other
+                    # rejection (e.g. the hook's 403) stays terminal, so the
+                    # device does not mint a certificate on every restart.
+                    self.journal.reset()
+                    raise ProvisioningError(str(e), e.step, retryable=True) from e
+                raise
+            self.journal.record('thing_registered', thing_name=registration.get('thingName'))
+            self.logger.info('##### CERT ACTIVATED AND THING {} CREATED #####'.format(
+                registration['thingName']))
+            print('##### CERT ACTIVATED AND THING {} CREATED #####'.format(
+                registration['thingName']))
+        finally:
+            await self.wait(self.primary_connection.disconnect())
+
+    async def run_step(self, step, action):
+        """Runs action and waits for the response settling step, raising
+        ProvisioningError if it is rejected or times out."""
+        future = self.loop.create_future()
+        self.pending[step] = future
+        start = time.monotonic()
+        try:
+            action()
+            return await asyncio.wait_for(future, self.step_timeout)
+        except asyncio.TimeoutError:
+            raise ProvisioningError('{} timed out after {}s'.format(
+                step, self.step_timeout), step)
+        finally:
+            self.pending.pop(step, None)
+            self.timings[step] = time.monotonic() - start
+
+    def settle(self, step, result=None, error=None):
+        """Resolves the future of step; safe to call from any thread."""
+        def resolve():
+            future = self.pending.get(step)
+            if future is None or future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        try:
+            self.loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            # Late response after the flow finished and the loop closed.
+            pass
 
-    def on_message_callback(self, message):
+    def on_message_callback(self, topic, payload, **kwargs):
         """ Callback Message handler responsible for workflow routing of msg responses from provisioning services.
 
         Arguments:
-                message {string} -- The response message payload.
+                payload {bytes} -- The response message payload.
         """
-        json_data = json.loads(message.payload)
+        json_data = json.loads(payload)
 
         # A response has been recieved from the service that contains certificate data.
         if 'certificateId' in json_data:
-            self.logger.info('##### SUCCESS. SAVING KEYS TO DEVICE! #####')
-            print('##### SUCCESS. SAVING KEYS TO DEVICE! #####')
-            self.assemble_certificates(json_data)
+            self.settle('create_keys', json_data)
 
         # A response contains acknowledgement that the provisioning template has been acted upon.
         elif 'deviceConfiguration' in json_data:
-            self.logger.info('##### CERT ACTIVATED AND THING {} CREATED #####'.format(
-                json_data['thingName']))
-            print('##### CERT ACTIVATED AND THING {} CREATED #####'.format(
-                json_data['thingName']))
-            self.rotate_certs()
+            self.settle('register_thing', json_data)
         else:
             self.logger.info(json_data)
 
+    def rejected_callback(self, topic, payload, **kwargs):
+        """Fails the step whose request was rejected."""
+        step = 'create_keys' if topic.startswith('$aws/certificates') else 'register_thing'
+        try:
+            response = dict(json.loads(payload))
+        except (ValueError, TypeError):
+            response = {}
+        try:
+            status_code = int(response.get('statusCode'))
+        except (ValueError, TypeError):
+            status_code = None
+        token_rejected = step == 'register_thing' and is_token_rejection(
+            response.get('errorCode'), response.get('errorMessage'))
+        self.settle(step, error=ProvisioningError('{} rejected: {}'.format(
+            step, payload.decode()), step, is_retryable(status_code), token_rejected))
+
     def assemble_certificates(self, payload):
         """ Method takes the payload and constructs/saves the certificate and private key. Method uses
         existing AWS IoT Core naming convention.
@@ -159,28 +386,16 @@ class ProvisioningHandler:
         Returns:
                 ownership_token {string} -- proof of ownership from certificate issuance activity.
         """
-        # Cert ID
-        cert_id = payload['certificateId']
-        self.new_key_root = cert_id[0:10]
-
-        self.new_cert_name = '{}-certificate.pem.crt'.format(self.new_key_root)
-        # Create certificate
-        f = open('{}/{}'.format(self.secure_cert_path, self.new_cert_name), 'w+')
-        f.write(payload['certificatePem'])
-        f.close()
-
-        # Create private key
-        self.new_key_name = '{}-private.pem.key'.format(self.new_key_root)
-        f = open('{}/{}'.format(self.secure_cert_path, self.new_key_name), 'w+')
-        f.write(payload['privateKey'])
-        f.close()
+        # Written atomically; they only become the device's credentials in
+        # the manifest once rotate_certs() has tested them.
+        self.new_credentials = self.credential_store.save(
+            payload['certificateId'], payload['certificatePem'], payload['privateKey'])
+        self.new_cert_name = self.new_credentials['cert']
+        self.new_key_name = self.new_credentials['key']
 
         # Extract/return Ownership token
         self.ownership_token = payload['certificateOwnershipToken']
 
-        # register newly aquired cert
-        self.register_thing(self.device_id, self.ownership_token)
-
     def register_thing(self, serial, token):
         """Calls the fleet provisioning service responsible for acting upon instructions within device templates.
 
@@ -197,16 +412,34 @@ class ProvisioningHandler:
             "SerialNumber": self.device_id, "ModelType": self.model_type, "hasValidAccount": self.hasValidAccount}}
 
         # Register thing / activate certificate
-        self.primary_MQTTClient.publish("$aws/provisioning-templates/{}/provision/json".format(
-            self.template_name), json.dumps(register_template), 0)
+        self.publish(self.primary_connection, "$aws/provisioning-templates/{}/provision/json".format(
+            self.template_name), json.dumps(register_template))
 
-    def rotate_certs(self):
+    async def rotate_certs(self):
         """Responsible for (re)connecting to IoTCore with the newly provisioned/activated certificate - (first class citizen cert)
         """
         self.logger.info('##### CONNECTING WITH OFFICIAL CERT #####')
         print('##### CONNECTING WITH OFFICIAL CERT #####')
-        self.cert_validation_test()
-        self.new_cert_pub_sub()
+        self.production_connection = None
+        try:
+            await self.cert_validation_test()
+            if not self.journal.get('cert_validated'):
+                await self.run_step('validate_cert', self.new_cert_pub_sub)
+                self.journal.record('cert_validated')
+            unsubscribe_future, _ = self.production_connection.unsubscribe(
+                "dt/{}/test".format(self.device_id))
+            await self.wait(unsubscribe_future)
+        except Exception:
+            # Do not leave a half-validated connection behind for the next attempt.
+            if self.production_connection is not None:
+                try:
+                    await self.wait(self.production_connection.disconnect())
+                except Exception as e:
+                    print('Disconnecting the production connection failed: {}'.format(e))
+            raise
+        self.credential_store.activate(self.new_credentials)
+        self.journal.complete()
+        print("##### PROVISIONING STATS {} #####".format(self.journal.stats()))
         print("##### ACTIVATED AND TESTED CREDENTIALS ({}, {}). #####".format(
             self.new_key_name, self.new_cert_name))
         print("##### FILES SAVED TO {} #####".format(self.secure_cert_path))
@@ -214,34 +447,31 @@ class ProvisioningHandler:
         print("##### REMOVED BOOTSTRAP CREDENTIALS #####".format(
             self.secure_cert_path))
 
-    def cert_validation_test(self):
-
-        self.test_MQTTClient = AWSIoTMQTTClient(self.device_id)
-        self.test_MQTTClient.configureEndpoint(self.iot_endpoint, 8883)
-        self.test_MQTTClient.configureCredentials("{}/{}".format(self.secure_cert_path,
-                                                                 self.root_cert), "{}/{}".format(self.secure_cert_path, self.new_key_name),
-                                                  "{}/{}".format(self.secure_cert_path, self.new_cert_name))
-        # Infinite offline Publish queueing
-        self.test_MQTTClient.configureOfflinePublishQueueing(-1)
-        self.test_MQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
-        self.test_MQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
-        self.test_MQTTClient.configureMQTTOperationTimeout(3)  # 5 sec
-        self.test_MQTTClient.connect()
-
-    def basic_callback(self, client, userdata, msg):
+    async def cert_validation_test(self):
+        # The connection is kept open and handed back by provision(), so the
+        # device agent does not pay for another TLS handshake.
+        self.production_connection = self.connection_factory(
+            "{}/{}".format(self.secure_cert_path, self.new_cert_name),
+            "{}/{}".format(self.secure_cert_path, self.new_key_name),
+            self.device_id, clean_session=False)
+        start = time.monotonic()
+        await self.wait(self.production_connection.connect())
+        self.timings['production_connect'] = time.monotonic() - start
+        await self.subscribe(self.production_connection,
+                             "dt/{}/test".format(self.device_id), self.basic_callback)
+
+    def basic_callback(self, topic, payload, **kwargs):
         """Method responding to the openworld publish attempt. Demonstrating a successful pub/sub with new certificate.
         """
-        self.logger.info(msg.payload.decode())
-        self.message_payload = msg.payload.decode()
-        self.callback_returned = True
+        self.logger.info(payload.decode())
+        self.message_payload = payload.decode()
+        self.settle('validate_cert', self.message_payload)
 
     def new_cert_pub_sub(self):
         """Method testing a call to the 'openworld' topic (which was specified in the policy for the new certificate)
         """
-        self.test_MQTTClient.subscribe(
-            "dt/{}/test".format(self.device_id), 1, self.basic_callback)
-        self.test_MQTTClient.publish("dt/{}/test".format(self.device_id), str(
-            {"service_response": "##### YOUR INDIVIDUALIZED PRODUCTION CERTS HAVE BEEN SUCCESSFULLY ACTIVATED AND ADDED TO THE /certs FOLDER #####"}), 0)
+        self.publish(self.production_connection, "dt/{}/test".format(self.device_id), str(
+            {"service_response": "##### YOUR INDIVIDUALIZED PRODUCTION CERTS HAVE BEEN SUCCESSFULLY ACTIVATED AND ADDED TO THE /certs FOLDER #####"}))
 
     def remove_bootstrap_certs(self):
         try:
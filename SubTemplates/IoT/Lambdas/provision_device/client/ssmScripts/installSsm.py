@@ -0,0 +1,223 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+# Installs and registers the SSM agent on Debian based Linux devices.
+#
+#  A downloaded package is verified against the GPG signature AWS publishes
+#  next to it (<package>.deb.sig), using the SSM agent public key from the AWS
+#  documentation saved as amazon-ssm-agent.gpg next to this script; without
+#  that key file the signature cannot be checked and a warning is printed.
+#  Verified packages are kept in a per architecture cache next to this script
+#  with a .sha256 sidecar, which only detects a cached file damaged on disk;
+#  such a package is downloaded (and verified) again. The package is only
+#  (re)installed when the installed version differs from the latest release,
+#  so toggling SSM on a device that already has the agent only re-registers it
+#  with the new activation.
+#
+#  Usage:
+#      python3 installSsm.py <activation code> <activation id> <region>
+# ------------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+packageName = 'amazon-ssm-agent'
+releaseUrl = 'https://s3.amazonaws.com/ec2-downloads-windows/SSMAgent'
+cacheDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'installer')
+signingKey = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'amazon-ssm-agent.gpg')
+downloadTimeout = 60
+
+architectures = {
+    'aarch64': 'debian_arm64',
+    'arm64': 'debian_arm64',
+    'armv6l': 'debian_arm',
+    'armv7l': 'debian_arm',
+    'x86_64': 'debian_amd64',
+    'amd64': 'debian_amd64',
+    'i386': 'debian_386',
+    'i686': 'debian_386'
+}
+
+timings = {}
+
+
+def timed(step):
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings[step] = round(time.monotonic() - start, 3)
+                print('{} took {}s'.format(step, timings[step]), flush=True)
+        return wrapper
+    return decorator
+
+
+def privileged(command):
+    if os.geteuid() != 0:
+        return ['sudo'] + command
+    return command
+
+
+def run(command, **kwargs):
+    print(' '.join(command), flush=True)
+    return subprocess.run(privileged(command), check=True, **kwargs)
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as package:
+        for chunk in iter(lambda: package.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@timed('check_installed')
+def installedVersion():
+    try:
+        output = subprocess.run(
+            ['dpkg-query', '-W', '-f=${Status} ${Version}', packageName],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout
+    except OSError:
+        return None
+    if not output.startswith('install ok installed'):
+        return None
+    # Drop the Debian revision so it compares with the release VERSION file.
+    return output.split()[-1].split('-')[0]
+
+
+@timed('check_latest')
+def latestVersion():
+    try:
+        with urllib.request.urlopen('{}/latest/VERSION'.format(releaseUrl),
+                                    timeout=downloadTimeout) as response:
+            return response.read().decode('utf-8').strip()
+    except Exception as e:
+        print('Could not read latest agent version: {}'.format(e), flush=True)
+        return None
+
+
+def fetch(url, path):
+    with urllib.request.urlopen(url, timeout=downloadTimeout) as response, \
+            open(path, 'wb') as target:
+        for chunk in iter(lambda: response.read(1024 * 1024), b''):
+            target.write(chunk)
+
+
+@timed('verify')
+def verifySignature(path, url):
+    """Checks path against the detached signature published at url.sig;
+    raises CalledProcessError if gpg rejects it."""
+    if not os.path.exists(signingKey):
+        print('WARNING: {} not found, package signature not verified'.format(
+            signingKey), flush=True)
+        return
+    signature = path + '.sig'
+    fetch(url + '.sig', signature)
+    try:
+        # A throwaway keyring, so only the SSM agent key is trusted.
+        with tempfile.TemporaryDirectory() as home:
+            gpg = ['gpg', '--batch', '--homedir', home]
+            subprocess.run(gpg + ['--import', signingKey], check=True)
+            subprocess.run(gpg + ['--verify', signature, path], check=True)
+    finally:
+        os.remove(signature)
+
+
+def cachedPackage(arch, version):
+    path = os.path.join(cacheDir, arch, '{}-{}.deb'.format(packageName, version))
+    try:
+        with open(path + '.sha256') as sidecar:
+            expected = sidecar.read().strip()
+    except OSError:
+        return None
+    if os.path.exists(path) and sha256(path) == expected:
+        return path
+    print('Cached package {} failed its checksum'.format(path), flush=True)
+    return None
+
+
+@timed('download')
+def downloadPackage(arch, version):
+    directory = os.path.join(cacheDir, arch)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}-{}.deb'.format(packageName, version))
+    tmpPath = path + '.part'
+    url = '{}/{}/{}/{}.deb'.format(releaseUrl, version, arch, packageName)
+    print('Downloading {}'.format(url), flush=True)
+    fetch(url, tmpPath)
+    try:
+        verifySignature(tmpPath, url)
+    except Exception:
+        os.remove(tmpPath)
+        raise
+    os.replace(tmpPath, path)
+    # Detects a cached package damaged on disk; the signature was checked above.
+    with open(path + '.sha256', 'w') as sidecar:
+        sidecar.write(sha256(path))
+
+    # Only the package for the current version is worth keeping.
+    for name in os.listdir(directory):
+        if not name.startswith(os.path.basename(path)):
+            os.remove(os.path.join(directory, name))
+    return path
+
+
+@timed('install')
+def installPackage(path):
+    run(['dpkg', '-i', path])
+
+
+@timed('register')
+def registerAgent(code, activationId, region):
+    run(['service', packageName, 'stop'])
+    # -register asks for confirmation when the device was registered before.
+    run([packageName, '-register', '-code', code, '-id', activationId,
+         '-region', region], input=b'yes\n')
+    run(['service', packageName, 'start'])
+    run(['systemctl', 'enable', packageName])
+
+
+def install(code, activationId, region):
+    arch = architectures.get(platform.machine().lower())
+    if arch is None:
+        raise RuntimeError('Unsupported architecture {}'.format(platform.machine()))
+
+    installed = installedVersion()
+    latest = latestVersion()
+    print('Installed version: {}, latest version: {}'.format(
+        installed, latest), flush=True)
+
+    if latest is None and installed is None:
+        raise RuntimeError('SSM agent is not installed and cannot be downloaded')
+    if latest is not None and latest != installed:
+        path = cachedPackage(arch, latest) or downloadPackage(arch, latest)
+        installPackage(path)
+    else:
+        print('SSM agent is up to date, skipping install', flush=True)
+
+    registerAgent(code, activationId, region)
+
+
+def main():
+    if len(sys.argv) != 4:
+        sys.exit('usage: installSsm.py <activation code> <activation id> <region>')
+    start = time.monotonic()
+    install(*sys.argv[1:])
+    timings['total'] = round(time.monotonic() - start, 3)
+    print('SSM Agent Activation Complete', flush=True)
+    print(json.dumps({'timings': timings}), flush=True)
+
+
+if __name__ == '__main__':
+    main()
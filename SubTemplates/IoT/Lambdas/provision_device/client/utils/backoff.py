@@ -0,0 +1,22 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import hashlib
+import random
+
+
+def full_jitter(attempt, base, cap):
+    """Seconds to wait before retry number attempt (0 based): uniform between
+    0 and the exponential backoff, so clients that failed together do not
+    retry together."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def spread(key, window):
+    """A stable offset in [0, window) seconds derived from key (e.g. the
+    device ID), spreading a fleet that starts at the same instant evenly
+    over the window."""
+    digest = hashlib.sha256(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2.0 ** 64 * window
@@ -0,0 +1,169 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import itertools
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+
+# Keeps a status message well under the 128KB MQTT payload limit.
+maxOutputLines = 50
+
+
+class CommandExecutor:
+    """Runs commands one at a time on a worker thread so long installs never
+    block the MQTT event-loop thread. Jobs wait in a bounded queue; output is
+    reported through publish(status) in batches every progress_interval
+    seconds, followed by a final status with the exit code. A job is killed
+    when it runs longer than its timeout or is cancelled."""
+
+    def __init__(self, publish, max_queue=4, default_timeout=900,
+                 progress_interval=2):
+        self.publish = publish
+        self.default_timeout = default_timeout
+        self.progress_interval = progress_interval
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.cancelled = set()
+        self.current = None
+        self.worker = None
+
+    def start(self):
+        self.worker = threading.Thread(
+            target=self._run, name='command-executor', daemon=True)
+        self.worker.start()
+
+    def stop(self, timeout=10):
+        self.cancel()
+        self.jobs.put(None)
+        self.worker.join(timeout)
+
+    def submit(self, name, args, timeout=None):
+        """Queue a command, returning its job id, or None if the queue is full."""
+        job = {
+            'job_id': next(self.ids),
+            'command': name,
+            'args': args,
+            'timeout': timeout or self.default_timeout
+        }
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            self._report(job, 'rejected', reason='queue full')
+            return None
+        self._report(job, 'queued')
+        return job['job_id']
+
+    def cancel(self, name=None):
+        """Cancel queued and running jobs, or only those for command name."""
+        with self.lock:
+            for job in list(self.jobs.queue):
+                if job and (name is None or job['command'] == name):
+                    self.cancelled.add(job['job_id'])
+            current = self.current
+            if current and (name is None or current['command'] == name):
+                self.cancelled.add(current['job_id'])
+                if 'process' in current:
+                    self._kill(current['process'])
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            with self.lock:
+                skip = job['job_id'] in self.cancelled
+                if skip:
+                    self.cancelled.discard(job['job_id'])
+                else:
+                    self.current = job
+            if skip:
+                self._report(job, 'cancelled')
+                continue
+            try:
+                self._execute(job)
+            except Exception as e:
+                self._report(job, 'failed', reason=str(e))
+            finally:
+                with self.lock:
+                    self.current = None
+                    self.cancelled.discard(job['job_id'])
+
+    def _execute(self, job):
+        start = time.monotonic()
+        process = subprocess.Popen(
+            job['args'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            start_new_session=os.name == 'posix')
+        with self.lock:
+            job['process'] = process
+            if job['job_id'] in self.cancelled:
+                self._kill(process)
+        timedOut = threading.Event()
+
+        def expire():
+            timedOut.set()
+            self._kill(process)
+
+        timer = threading.Timer(job['timeout'], expire)
+        timer.daemon = True
+        timer.start()
+        self._report(job, 'running')
+
+        lines = []
+        lastReport = time.monotonic()
+        try:
+            for line in process.stdout:
+                print(line, end='')
+                lines.append(line.rstrip()[:500])
+                del lines[:-maxOutputLines]
+                if time.monotonic() - lastReport >= self.progress_interval:
+                    self._report(job, 'running', output=lines)
+                    lines = []
+                    lastReport = time.monotonic()
+            exitCode = process.wait()
+        finally:
+            timer.cancel()
+            with self.lock:
+                cancelled = job['job_id'] in self.cancelled
+
+        if timedOut.is_set():
+            state = 'timeout'
+        elif cancelled:
+            state = 'cancelled'
+        elif exitCode == 0:
+            state = 'succeeded'
+        else:
+            state = 'failed'
+        self._report(job, state, output=lines, exit_code=exitCode,
+                     duration=round(time.monotonic() - start, 3))
+
+    def _kill(self, process):
+        if process.poll() is not None:
+            return
+        try:
+            if os.name == 'posix':
+                # The scripts run sudo/dpkg children; end the whole group.
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
+
+    def _report(self, job, state, **fields):
+        status = {'job_id': job['job_id'],
+                  'command': job['command'], 'state': state}
+        status.update((key, value) for key, value in fields.items()
+                      if value not in (None, []))
+        try:
+            self.publish(status)
+        except Exception as e:
+            print('Failed to publish command status: {}'.format(e))
@@ -0,0 +1,114 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import queue
+import threading
+import time
+
+# Latency samples kept per command.
+maxSamples = 200
+
+
+class CommandRouter:
+    """Dispatches messages from a single cmd/<device_id>/# subscription to the
+    handler registered for the rest of the topic (e.g. 'ssm/activate').
+
+    Each command has its own bounded queue drained by `concurrency` worker
+    threads, so a slow command cannot hold up another one and the MQTT
+    event-loop thread only enqueues. A message arriving while the queue is
+    full is rejected through on_rejected(command, reason)."""
+
+    def __init__(self, prefix, on_rejected=None):
+        self.prefix = prefix.rstrip('/') + '/'
+        self.on_rejected = on_rejected
+        self.commands = {}
+        self.lock = threading.Lock()
+        self.unknown = 0
+
+    @property
+    def topic_filter(self):
+        return self.prefix + '#'
+
+    def register(self, suffix, handler, concurrency=1, max_queue=4):
+        """handler(topic, payload) runs on one of the command's worker threads."""
+        self.commands[suffix] = {
+            'handler': handler,
+            'concurrency': concurrency,
+            'queue': queue.Queue(maxsize=max_queue),
+            'workers': [],
+            'stats': {'received': 0, 'rejected': 0, 'failed': 0,
+                      'wait': [], 'duration': []}
+        }
+
+    def start(self):
+        for suffix, command in self.commands.items():
+            for index in range(command['concurrency']):
+                worker = threading.Thread(
+                    target=self._run, args=(suffix, command),
+                    name='command-{}-{}'.format(suffix, index), daemon=True)
+                worker.start()
+                command['workers'].append(worker)
+
+    def stop(self, timeout=10):
+        for command in self.commands.values():
+            for _ in command['workers']:
+                command['queue'].put(None)
+        for command in self.commands.values():
+            for worker in command['workers']:
+                worker.join(timeout)
+
+    def dispatch(self, topic, payload, **kwargs):
+        """Subscription callback for topic_filter."""
+        suffix = topic[len(self.prefix):] if topic.startswith(self.prefix) else None
+        command = self.commands.get(suffix)
+        if command is None:
+            with self.lock:
+                self.unknown += 1
+            print("No handler for command topic '{}'".format(topic))
+            return
+        with self.lock:
+            command['stats']['received'] += 1
+        try:
+            command['queue'].put_nowait((topic, payload, time.monotonic()))
+        except queue.Full:
+            with self.lock:
+                command['stats']['rejected'] += 1
+            if self.on_rejected:
+                self.on_rejected(suffix, 'queue full')
+
+    def stats(self):
+        """Counts and latency (seconds queued, seconds running) per command."""
+        stats = {'unknown': self.unknown}
+        with self.lock:
+            for suffix, command in self.commands.items():
+                current = dict(command['stats'])
+                for key in ('wait', 'duration'):
+                    samples = sorted(current.pop(key))
+                    if samples:
+                        current[key + '_p50'] = round(samples[len(samples) // 2], 3)
+                        current[key + '_max'] = round(samples[-1], 3)
+                current['queued'] = command['queue'].qsize()
+                stats[suffix] = current
+        return stats
+
+    def _run(self, suffix, command):
+        stats = command['stats']
+        while True:
+            message = command['queue'].get()
+            if message is None:
+                return
+            topic, payload, received = message
+            start = time.monotonic()
+            try:
+                command['handler'](topic, payload)
+            except Exception as e:
+                print("Command '{}' failed: {}".format(suffix, e))
+                with self.lock:
+                    stats['failed'] += 1
+            with self.lock:
+                for key, value in (('wait', start - received),
+                                   ('duration', time.monotonic() - start)):
+                    stats[key].append(value)
+                    del stats[key][:-maxSamples]
@@ -0,0 +1,147 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import hashlib
+import json
+import os
+import time
+
+from utils.fileio import atomic_write
+
+manifestName = 'manifest.json'
+manifestVersion = 1
+
+
+def fingerprint(path):
+    with open(path, 'rb') as credential:
+        return hashlib.sha256(credential.read()).hexdigest()
+
+
+class CredentialStore:
+    """Production certificate and key of the device, indexed by a manifest in
+    the certificate folder:
+
+        {"version": 1,
+         "active":   {"cert_id", "cert", "key", "cert_sha256", "key_sha256", "created"},
+         "previous": {...}}
+
+    Files and manifest are written with atomic_write, so a power loss never
+    leaves a partial key behind. New credentials are saved first and only
+    become active once they have been tested; the credentials they replace
+    are kept as previous so a rotation can be rolled back."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, manifestName)
+        self.manifest = self._read_manifest()
+
+    def path(self, name):
+        return '{}/{}'.format(self.directory, name)
+
+    def active(self):
+        """The active entry, falling back to the previous one if the active
+        files are missing or do not match their fingerprints; None if the
+        device has no usable production credentials."""
+        for slot in ('active', 'previous'):
+            entry = self.manifest.get(slot)
+            if entry and self.verify(entry):
+                if slot == 'previous':
+                    print('Active credentials failed verification, rolling back')
+                    self.rollback()
+                return entry
+        return None
+
+    def save(self, cert_id, certificate_pem, private_key):
+        """Write new credentials and return their (not yet active) entry."""
+        root = cert_id[0:10]
+        entry = {
+            'cert_id': cert_id,
+            'cert': '{}-certificate.pem.crt'.format(root),
+            'key': '{}-private.pem.key'.format(root),
+            'created': int(time.time())
+        }
+        atomic_write(self.path(entry['cert']), certificate_pem, mode=0o644)
+        atomic_write(self.path(entry['key']), private_key)
+        entry['cert_sha256'] = fingerprint(self.path(entry['cert']))
+        entry['key_sha256'] = fingerprint(self.path(entry['key']))
+        return entry
+
+    def activate(self, entry):
+        """Make entry the active credentials, keeping the current ones as
+        previous. Credentials from before that are deleted."""
+        active = self.manifest.get('active')
+        if active and active['cert_id'] == entry['cert_id']:
+            return
+        stale = self.manifest.get('previous')
+        self.manifest['previous'] = active
+        self.manifest['active'] = entry
+        self._write_manifest()
+        if stale and stale['cert_id'] != entry['cert_id']:
+            self._remove(stale)
+
+    def rollback(self):
+        """Swap back to the previous credentials after a failed rotation."""
+        if not self.manifest.get('previous'):
+            return False
+        self.manifest['active'], self.manifest['previous'] = \
+            self.manifest['previous'], self.manifest.get('active')
+        self._write_manifest()
+        return True
+
+    def verify(self, entry):
+        try:
+            return (fingerprint(self.path(entry['cert'])) == entry['cert_sha256'] and
+                    fingerprint(self.path(entry['key'])) == entry['key_sha256'])
+        except OSError:
+            return False
+
+    def migrate_legacy(self, bootstrap_cert, bootstrap_key):
+        """Adopt credentials saved before the manifest existed, which were
+        found by file name. Runs once; afterwards the manifest is used."""
+        if self.manifest.get('active') or not os.path.isdir(self.directory):
+            return None
+        certs = {}
+        keys = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('-certificate.pem.crt') and name != bootstrap_cert:
+                certs[name[:-len('-certificate.pem.crt')]] = name
+            elif name.endswith('-private.pem.key') and name != bootstrap_key:
+                keys[name[:-len('-private.pem.key')]] = name
+        pairs = sorted(set(certs) & set(keys), reverse=True,
+                       key=lambda root: os.path.getmtime(self.path(certs[root])))
+        if not pairs:
+            return None
+        root = pairs[0]
+        entry = {
+            'cert_id': root,
+            'cert': certs[root],
+            'key': keys[root],
+            'cert_sha256': fingerprint(self.path(certs[root])),
+            'key_sha256': fingerprint(self.path(keys[root])),
+            'created': int(os.path.getmtime(self.path(certs[root])))
+        }
+        print('Migrated credentials {} to {}'.format(certs[root], manifestName))
+        self.activate(entry)
+        return entry
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as manifest:
+                data = json.load(manifest)
+        except (OSError, ValueError):
+            return {'version': manifestVersion}
+        if data.get('version') != manifestVersion:
+            return {'version': manifestVersion}
+        return data
+
+    def _write_manifest(self):
+        atomic_write(self.manifest_path, json.dumps(self.manifest, indent=2))
+
+    def _remove(self, entry):
+        for name in (entry['cert'], entry['key']):
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
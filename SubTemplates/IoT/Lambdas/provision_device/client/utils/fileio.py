@@ -0,0 +1,42 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import os
+import tempfile
+
+
+def atomic_write(path, data, mode=0o600):
+    """Replace path with data so that after a power loss it holds either the
+    old or the new content, never a partial write. data is str or bytes."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    fd, tmpPath = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as tmpFile:
+            tmpFile.write(data)
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        os.chmod(tmpPath, mode)
+        os.replace(tmpPath, path)
+    except BaseException:
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        raise
+    fsync_directory(directory)
+
+
+def fsync_directory(directory):
+    """Persist a rename in directory (a no-op where directories cannot be
+    opened, e.g. on Windows)."""
+    if os.name != 'posix':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
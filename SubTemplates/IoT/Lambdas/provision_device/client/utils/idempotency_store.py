@@ -0,0 +1,110 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import collections
+import json
+import os
+import threading
+import time
+
+from utils.fileio import atomic_write
+
+
+class IdempotencyStore:
+    """Remembers the ids of handled commands (activationId, messageId) so a
+    QoS1 redelivery, including one after a restart, is not run twice.
+
+    An id is recorded as started when its command is accepted and as finished
+    once the command succeeded; a command that failed is discarded so its
+    redelivery runs again. Ids still started when the process stopped (e.g. a
+    reboot in the middle of an install) are forgotten on load.
+
+    Ids are held in an ordered dict for constant time lookups and appended to
+    a log file as one JSON line each; the log is rewritten without expired or
+    evicted ids once it holds twice max_entries lines. At most max_entries
+    ids are kept, the oldest are forgotten first."""
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.lines = 0
+        self._load()
+
+    def check_and_add(self, key, expires_at):
+        """Record key as started until expires_at (epoch seconds). Returns
+        False if key is already started or finished and has not expired,
+        i.e. is a duplicate."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                return False
+            self._append(key, expires_at, 'started', now)
+            return True
+
+    def finish(self, key):
+        """Mark a started key as finished, so it stays a duplicate after a restart."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] != 'finished':
+                self._append(key, entry[0], 'finished', time.time())
+
+    def discard(self, key):
+        """Forget key, e.g. when its command failed, so a redelivery runs again."""
+        with self.lock:
+            if key in self.entries:
+                self._append(key, 0, 'discarded', time.time())
+
+    def _append(self, key, expires_at, state, now):
+        if state == 'discarded':
+            del self.entries[key]
+        else:
+            self.entries[key] = (expires_at, state)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        with open(self.path, 'a') as log:
+            log.write(json.dumps(
+                {'key': key, 'expires': expires_at, 'state': state}) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        self.lines += 1
+        if self.lines >= 2 * self.max_entries:
+            self._compact(now)
+
+    def _load(self):
+        try:
+            with open(self.path) as log:
+                for line in log:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line torn by a power cut
+                    self.lines += 1
+                    state = entry['state']
+                    if state == 'discarded':
+                        self.entries.pop(entry['key'], None)
+                        continue
+                    self.entries[entry['key']] = (entry['expires'], state)
+                    self.entries.move_to_end(entry['key'])
+        except OSError:
+            return
+        # Commands started by a previous process did not finish.
+        for key in [key for key, (_, state) in self.entries.items()
+                    if state == 'started']:
+            del self.entries[key]
+        self._compact(time.time())
+
+    def _compact(self, now):
+        for key in [key for key, (expiry, _) in self.entries.items() if expiry <= now]:
+            del self.entries[key]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        atomic_write(self.path, ''.join(
+            json.dumps({'key': key, 'expires': expiry, 'state': state}) + '\n'
+            for key, (expiry, state) in self.entries.items()), mode=0o644)
+        self.lines = len(self.entries)
@@ -0,0 +1,233 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import collections
+import os
+import struct
+import threading
+import zlib
+
+# length, crc32 of the body, topic length
+recordHeader = struct.Struct('>IIH')
+segmentSuffix = '.seg'
+dropOldest = 'drop-oldest'
+dropNewest = 'drop-newest'
+
+
+class OfflineQueue:
+    """Bounded publish queue persisted to disk so messages survive a reboot
+    without growing memory while the device is offline.
+
+    Messages are appended to segment files as length and crc32 framed records;
+    a head file records the position of the oldest unsent message. Only the
+    record positions are kept in memory. When the queue is full, policy
+    'drop-oldest' discards the oldest message and 'drop-newest' rejects the
+    new one."""
+
+    def __init__(self, directory, max_messages=1000, max_bytes=1024 * 1024,
+                 segment_bytes=64 * 1024, policy=dropOldest, fsync=True):
+        if policy not in (dropOldest, dropNewest):
+            raise ValueError('Unknown offline queue policy {}'.format(policy))
+        self.directory = directory
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.policy = policy
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.records = collections.deque()
+        self.bytes = 0
+        self.dropped = 0
+        self.sent = 0
+        self.segment = 0
+        self.segment_size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def put(self, topic, payload):
+        """Append a message, returning False if it was not queued."""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        encodedTopic = topic.encode('utf-8')
+        body = encodedTopic + payload
+        record = recordHeader.pack(len(body), zlib.crc32(body), len(encodedTopic)) + body
+        with self.lock:
+            if len(record) > self.max_bytes:
+                self.dropped += 1
+                return False
+            while self.records and (len(self.records) >= self.max_messages or
+                                    self.bytes + len(record) > self.max_bytes):
+                if self.policy == dropNewest:
+                    self.dropped += 1
+                    return False
+                self._advance()
+                self.dropped += 1
+            if self.segment_size >= self.segment_bytes:
+                self.segment += 1
+                self.segment_size = 0
+            with open(self._segment_path(self.segment), 'ab') as segment:
+                segment.write(record)
+                segment.flush()
+                if self.fsync:
+                    os.fsync(segment.fileno())
+            self.records.append((self.segment, self.segment_size, len(record)))
+            self.segment_size += len(record)
+            self.bytes += len(record)
+            return True
+
+    def peek(self):
+        """The oldest message as (position, topic, payload), or None."""
+        with self.lock:
+            if not self.records:
+                return None
+            position = self.records[0]
+            with open(self._segment_path(position[0]), 'rb') as segment:
+                segment.seek(position[1])
+                data = segment.read(position[2])
+        _, _, topicLength = recordHeader.unpack_from(data)
+        body = data[recordHeader.size:]
+        return position, body[:topicLength].decode('utf-8'), body[topicLength:]
+
+    def ack(self, position):
+        """Remove the message returned by peek() once it has been delivered.
+        Does nothing if it was dropped in the meantime."""
+        with self.lock:
+            if self.records and self.records[0] == position:
+                self._advance()
+                self.sent += 1
+
+    def metrics(self):
+        with self.lock:
+            return {'depth': len(self.records), 'bytes': self.bytes,
+                    'dropped': self.dropped, 'sent': self.sent}
+
+    def _advance(self):
+        segment, offset, size = self.records.popleft()
+        self.bytes -= size
+        if self.records:
+            head = self.records[0][:2]
+        else:
+            head = (self.segment, self.segment_size)
+        self._write_head(*head)
+        if head[0] != segment:
+            for name in os.listdir(self.directory):
+                if name.endswith(segmentSuffix) and int(name[:-len(segmentSuffix)]) < head[0]:
+                    os.remove(os.path.join(self.directory, name))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, '{:010d}{}'.format(segment, segmentSuffix))
+
+    def _write_head(self, segment, offset):
+        path = os.path.join(self.directory, 'head')
+        with open(path + '.tmp', 'w') as head:
+            head.write('{} {}\n'.format(segment, offset))
+            head.flush()
+            if self.fsync:
+                os.fsync(head.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, 'head')) as head:
+                headSegment, headOffset = (int(field) for field in head.read().split())
+        except (OSError, ValueError):
+            headSegment, headOffset = 0, 0
+        segments = sorted(int(name[:-len(segmentSuffix)])
+                          for name in os.listdir(self.directory)
+                          if name.endswith(segmentSuffix))
+        for segment in segments:
+            path = self._segment_path(segment)
+            if segment < headSegment:
+                os.remove(path)
+                continue
+            with open(path, 'rb') as segmentFile:
+                data = segmentFile.read()
+            offset = min(headOffset, len(data)) if segment == headSegment else 0
+            while offset + recordHeader.size <= len(data):
+                length, crc, _ = recordHeader.unpack_from(data, offset)
+                body = data[offset + recordHeader.size:offset + recordHeader.size + length]
+                if len(body) != length or zlib.crc32(body) != crc:
+                    break
+                size = recordHeader.size + length
+                self.records.append((segment, offset, size))
+                self.bytes += size
+                offset += size
+            if offset != len(data):
+                # A record torn by a power cut; drop it and anything after it.
+                with open(path, 'r+b') as segmentFile:
+                    segmentFile.truncate(offset)
+            self.segment, self.segment_size = segment, offset
+        if not self.records:
+            # Start over in a new segment so the head never points past it.
+            self.segment = max(segments + [headSegment]) + 1
+            self.segment_size = 0
+            self._write_head(self.segment, 0)
+        while len(self.records) > self.max_messages or self.bytes > self.max_bytes:
+            self._advance()
+            self.dropped += 1
+
+
+class QueuedPublisher:
+    """Sends the messages of an OfflineQueue in order from a worker thread,
+    only while the connection is up. publish(topic, payload) must return a
+    future that completes when the broker acknowledges the message; a message
+    is removed from the queue only then, so it is sent again after a failure
+    or a restart."""
+
+    def __init__(self, offline_queue, publish, publish_timeout=30, retry_delay=5):
+        self.queue = offline_queue
+        self.publish = publish
+        self.publish_timeout = publish_timeout
+        self.retry_delay = retry_delay
+        self.condition = threading.Condition()
+        self.online = False
+        self.stopping = False
+        self.worker = None
+
+    def start(self, online=True):
+        self.online = online
+        self.worker = threading.Thread(
+            target=self._run, name='queued-publisher', daemon=True)
+        self.worker.start()
+
+    def stop(self, timeout=10):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.worker.join(timeout)
+
+    def set_online(self, online):
+        """Called from the connection interrupted/resumed callbacks."""
+        with self.condition:
+            self.online = online
+            self.condition.notify()
+
+    def put(self, topic, payload):
+        queued = self.queue.put(topic, payload)
+        if not queued:
+            print('Offline queue full, dropped message for {}'.format(topic))
+        with self.condition:
+            self.condition.notify()
+        return queued
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopping or (
+                    self.online and self.queue.metrics()['depth']))
+                if self.stopping:
+                    return
+            message = self.queue.peek()
+            if message is None:
+                continue
+            position, topic, payload = message
+            try:
+                self.publish(topic, payload).result(self.publish_timeout)
+            except Exception as e:
+                print('Queued publish to {} failed: {}'.format(topic, e))
+                with self.condition:
+                    self.condition.wait_for(lambda: self.stopping, self.retry_delay)
+                continue
+            self.queue.ack(position)
@@ -0,0 +1,70 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import json
+import time
+
+from utils.fileio import atomic_write
+
+# Steps of fleet provisioning, in order.
+steps = ['keys_received', 'thing_registered', 'cert_validated']
+
+
+class ProvisioningJournal:
+    """Persists each completed provisioning step so a flow interrupted by a
+    reboot resumes where it stopped instead of minting another certificate:
+
+        {"attempt": {"keys_received": {...}, "thing_registered": {...}},
+         "stats": {"attempts": 3, "resumes": 1, "resumed_from": {"keys_received": 1}}}
+
+    The attempt is cleared when provisioning completes; stats are kept."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as journal:
+                self.data = json.load(journal)
+        except (OSError, ValueError):
+            self.data = {}
+        self.data.setdefault('attempt', {})
+        self.data.setdefault('stats', {'attempts': 0, 'resumes': 0, 'resumed_from': {}})
+
+    def begin(self):
+        """Start or resume an attempt, returning the last completed step or None."""
+        last = self.last_step()
+        stats = self.data['stats']
+        stats['attempts'] += 1
+        if last:
+            stats['resumes'] += 1
+            stats['resumed_from'][last] = stats['resumed_from'].get(last, 0) + 1
+        self._write()
+        return last
+
+    def last_step(self):
+        completed = [step for step in steps if step in self.data['attempt']]
+        return completed[-1] if completed else None
+
+    def get(self, step):
+        return self.data['attempt'].get(step)
+
+    def record(self, step, **fields):
+        fields['at'] = int(time.time())
+        self.data['attempt'][step] = fields
+        self._write()
+
+    def reset(self):
+        """Forget the current attempt, e.g. when its ownership token expired."""
+        self.data['attempt'] = {}
+        self._write()
+
+    def complete(self):
+        self.reset()
+
+    def stats(self):
+        return dict(self.data['stats'])
+
+    def _write(self):
+        # Holds the ownership token, so it is only readable by the agent.
+        atomic_write(self.path, json.dumps(self.data, indent=2))
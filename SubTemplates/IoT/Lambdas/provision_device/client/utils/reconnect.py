@@ -0,0 +1,112 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import asyncio
+import random
+import time
+
+from awscrt import mqtt
+
+from utils.backoff import full_jitter
+
+
+class ReconnectController:
+    """Reconnect policy and bookkeeping for the agent's awscrt connections.
+
+    awscrt reconnects on its own, doubling its delay from
+    reconnect_min_timeout_secs up to reconnect_max_timeout_secs; the minimum
+    is offset by a random jitter per process so a fleet dropped by the same
+    broker blip does not come back in lockstep. When a connection resumes
+    without its session, subscriptions are restored by a supervised task that
+    retries with backoff instead of exiting the process."""
+
+    def __init__(self, runtime, min_backoff=1, max_backoff=128, jitter=5):
+        self.runtime = runtime
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.listeners = []
+        self.interrupted_at = None
+        self.counters = {
+            'disconnects': 0,
+            'reconnects': 0,
+            'session_present': 0,
+            'session_lost': 0,
+            'resubscribes': 0,
+            'resubscribe_failures': 0
+        }
+        self.latencies = []
+
+    def connection_options(self):
+        """Keyword arguments for mqtt_connection_builder."""
+        minimum = int(round(self.min_backoff + random.uniform(0, self.jitter)))
+        return {
+            'reconnect_min_timeout_secs': max(minimum, 1),
+            'reconnect_max_timeout_secs': max(self.max_backoff, minimum, 1),
+            'on_connection_interrupted': self.on_interrupted,
+            'on_connection_resumed': self.on_resumed
+        }
+
+    def add_listener(self, listener):
+        """listener(online) is called from the connection's event-loop thread."""
+        self.listeners.append(listener)
+
+    def on_interrupted(self, connection, error, **kwargs):
+        print("Connection interrupted. error: {}".format(error))
+        self.counters['disconnects'] += 1
+        self.interrupted_at = time.monotonic()
+        self._notify(False)
+
+    def on_resumed(self, connection, return_code, session_present, **kwargs):
+        print("Connection resumed. return_code: {} session_present: {}".format(
+            return_code, session_present))
+        self.counters['reconnects'] += 1
+        if self.interrupted_at is not None:
+            self.latencies.append(time.monotonic() - self.interrupted_at)
+            del self.latencies[:-100]
+            self.interrupted_at = None
+        if session_present:
+            self.counters['session_present'] += 1
+        else:
+            self.counters['session_lost'] += 1
+        if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
+            print("Session did not persist. Resubscribing to existing topics...")
+            # Callbacks run on the connection's event-loop thread; the
+            # resubscribe runs on the agent's loop.
+            self.runtime.call_soon(self.runtime.supervise, 'resubscribe',
+                                   lambda: self.resubscribe(connection))
+        self._notify(True)
+        print('Reconnect metrics: {}'.format(self.metrics()))
+
+    async def resubscribe(self, connection):
+        attempt = 0
+        while True:
+            resubscribe_future, _ = connection.resubscribe_existing_topics()
+            results = await self.runtime.wait(resubscribe_future)
+            rejected = [topic for topic, qos in results['topics'] if qos is None]
+            if not rejected:
+                self.counters['resubscribes'] += 1
+                print("Resubscribe results: {}".format(results))
+                return
+            self.counters['resubscribe_failures'] += 1
+            delay = full_jitter(attempt, self.min_backoff, self.max_backoff)
+            print('Server rejected resubscribe to {}, retrying in {:.1f}s'.format(
+                rejected, delay))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def metrics(self):
+        metrics = dict(self.counters)
+        if self.latencies:
+            metrics['reconnect_latency_last'] = round(self.latencies[-1], 3)
+            metrics['reconnect_latency_max'] = round(max(self.latencies), 3)
+        return metrics
+
+    def _notify(self, online):
+        for listener in self.listeners:
+            try:
+                listener(online)
+            except Exception as e:
+                print('Connection listener failed: {}'.format(e))
@@ -0,0 +1,108 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+
+import asyncio
+import signal
+import sys
+import traceback
+
+
+class AgentRuntime:
+    """Owns the agent's event loop: runs the startup coroutine, supervises
+    long running tasks (restarting them if they fail), and on SIGTERM/SIGINT
+    cancels them and runs the registered shutdown hooks in reverse order.
+    The loop sleeps until there is work, so an idle agent does not wake up."""
+
+    def __init__(self, restart_delay=5):
+        self.restart_delay = restart_delay
+        self.loop = None
+        self.stopping = None
+        self.tasks = {}
+        self.shutdown_hooks = []
+        self.exit_code = 0
+
+    def supervise(self, name, factory):
+        """Run the coroutine returned by factory() until shutdown, starting it
+        again after restart_delay seconds whenever it raises. A task already
+        running under name is cancelled and replaced."""
+        previous = self.tasks.get(name)
+        if previous is not None:
+            previous.cancel()
+        self.tasks[name] = self.loop.create_task(
+            self._supervisor(name, factory))
+
+    def add_shutdown_hook(self, hook):
+        """hook is a callable or coroutine function run at shutdown."""
+        self.shutdown_hooks.append(hook)
+
+    def call_soon(self, callback, *args):
+        """Schedule callback on the event loop from any thread, e.g. from
+        awscrt callbacks which run on the connection's event-loop thread."""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self, exit_code=0):
+        self.exit_code = exit_code or self.exit_code
+        if self.loop and not self.stopping.is_set():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def wait(self, future):
+        """Await a concurrent.futures.Future such as those returned by awscrt."""
+        return await asyncio.wrap_future(future)
+
+    async def run(self, startup):
+        """Returns the exit code passed to stop()."""
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self._install_signal_handlers()
+        startupTask = self.loop.create_task(startup(self))
+        stoppingTask = self.loop.create_task(self.stopping.wait())
+        try:
+            # A signal during startup (e.g. while provisioning) cancels it.
+            await asyncio.wait({startupTask, stoppingTask},
+                               return_when=asyncio.FIRST_COMPLETED)
+            if startupTask.done():
+                startupTask.result()
+                await stoppingTask
+        finally:
+            for task in (startupTask, stoppingTask):
+                task.cancel()
+            await asyncio.gather(startupTask, stoppingTask,
+                                 return_exceptions=True)
+            await self._shutdown()
+        return self.exit_code
+
+    async def _supervisor(self, name, factory):
+        while not self.stopping.is_set():
+            try:
+                await factory()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print('Task {} failed, restarting in {}s'.format(
+                    name, self.restart_delay))
+                traceback.print_exc()
+                await asyncio.sleep(self.restart_delay)
+
+    def _install_signal_handlers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self.loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows event loops do not support add_signal_handler.
+                signal.signal(signum, lambda *args: self.stop())
+
+    async def _shutdown(self):
+        print('Shutting down...')
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        for hook in reversed(self.shutdown_hooks):
+            try:
+                result = hook()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                print('Shutdown hook failed: {}'.format(e), file=sys.stderr)
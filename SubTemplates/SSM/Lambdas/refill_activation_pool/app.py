@@ -0,0 +1,154 @@
+import boto3
+import datetime
+import os
+import time
+from botocore.config import Config
+from rate_limiter import RateLimiter
+
+ssmClient = boto3.client('ssm', config=Config(
+    retries={'max_attempts': 10, 'mode': 'adaptive'}))
+dynamoClient = boto3.client('dynamodb')
+
+resourceTag = os.environ['ResourceTag']
+automationServiceRole = os.environ['AutomationServiceRole']
+activationPoolSize = int(os.environ.get('ActivationPoolSize', 0))
+createActivationTps = float(os.environ.get('CreateActivationTps', 5))
+
+poolPrefix = 'activation_pool#'
+poolAvailable = 'available'
+# SSM caps hybrid activation expiry at 30 days; available slots are retired
+# once they could no longer give a device the two days it used to get.
+poolActivationLifetime = datetime.timedelta(days=29)
+poolRetireWindow = datetime.timedelta(days=3)
+batchGetLimit = 100
+deadlineMarginMillis = 10000
+
+# Paces this function's own CreateActivation calls; ToggleSSMFunction keeps a
+# separate limiter at the same rate.
+createActivationLimiter = RateLimiter(createActivationTps)
+
+
+def slotKey(slot):
+    return '{}{}'.format(poolPrefix, slot)
+
+
+def dynamoGetSlots():
+    keys = [slotKey(slot) for slot in range(activationPoolSize)]
+    items = {}
+    for i in range(0, len(keys), batchGetLimit):
+        request = {resourceTag: {
+            'Keys': [{'device': {'S': key}} for key in keys[i:i + batchGetLimit]]}}
+        attempt = 0
+        while request:
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+            response = dynamoClient.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(resourceTag, []):
+                items[item['device']['S']] = item
+            request = response.get('UnprocessedKeys')
+            attempt = attempt + 1
+    return items
+
+
+def createActivation(expirationDate):
+    createActivationLimiter.acquire()
+    return ssmClient.create_activation(
+        Description=resourceTag,
+        DefaultInstanceName=resourceTag,
+        IamRole=automationServiceRole,
+        RegistrationLimit=1,
+        ExpirationDate=expirationDate,
+        Tags=[
+            {
+                'Key': 'Project',
+                'Value': resourceTag
+            },
+            {
+                'Key': 'DeployGroup',
+                'Value': 'Prod'
+            }
+        ]
+    )
+
+
+def deleteActivation(activationId):
+    try:
+        ssmClient.delete_activation(
+            ActivationId=activationId
+        )
+    except Exception as e:
+        print(e)
+
+
+def retireSlot(key, item):
+    # Only retire the activation we read; a device may claim it meanwhile.
+    try:
+        dynamoClient.update_item(
+            TableName=resourceTag,
+            Key={'device': {'S': key}},
+            UpdateExpression='remove pool_state',
+            ConditionExpression='pool_state = :a AND activationId = :i',
+            ExpressionAttributeValues={
+                ':a': {'S': poolAvailable},
+                ':i': item['activationId']
+            }
+        )
+    except dynamoClient.exceptions.ConditionalCheckFailedException:
+        return False
+    deleteActivation(item['activationId']['S'])
+    return True
+
+
+def fillSlot(key, item):
+    expirationDate = datetime.datetime.today() + poolActivationLifetime
+    response = createActivation(expirationDate)
+    if item and 'activationId' in item:
+        condition = 'activationId = :o'
+        values = {':o': item['activationId']}
+    else:
+        condition = 'attribute_not_exists(activationId)'
+        values = {}
+    try:
+        dynamoClient.put_item(
+            TableName=resourceTag,
+            Item={
+                'device': {'S': key},
+                'pool_state': {'S': poolAvailable},
+                'activationId': {'S': response['ActivationId']},
+                'activationCode': {'S': response['ActivationCode']},
+                'expirationDate': {'S': expirationDate.strftime("%m/%d/%Y, %H:%M:%S")},
+                'expires': {'N': str(int(time.mktime(expirationDate.timetuple())))}
+            },
+            ConditionExpression=condition,
+            **({'ExpressionAttributeValues': values} if values else {})
+        )
+    except dynamoClient.exceptions.ConditionalCheckFailedException:
+        deleteActivation(response['ActivationId'])
+        return False
+    return True
+
+
+def handler(event, context):
+    counts = {'filled': 0, 'retired': 0, 'available': 0}
+    retireBefore = time.time() + poolRetireWindow.total_seconds()
+    slots = dynamoGetSlots()
+    for slot in range(activationPoolSize):
+        if context.get_remaining_time_in_millis() < deadlineMarginMillis:
+            break
+        key = slotKey(slot)
+        item = slots.get(key)
+        state = item['pool_state']['S'] if item and 'pool_state' in item else None
+        try:
+            if state == poolAvailable:
+                if int(item['expires']['N']) > retireBefore:
+                    counts['available'] = counts['available'] + 1
+                    continue
+                if not retireSlot(key, item):
+                    continue
+                counts['retired'] = counts['retired'] + 1
+            if fillSlot(key, item):
+                counts['filled'] = counts['filled'] + 1
+        except Exception as e:
+            print('error refilling {}: {}'.format(key, e))
+    print(counts)
+    return counts
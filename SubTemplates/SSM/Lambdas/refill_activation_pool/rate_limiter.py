@@ -0,0 +1,19 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls evenly at a fixed rate per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
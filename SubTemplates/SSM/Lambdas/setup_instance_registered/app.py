@@ -4,6 +4,8 @@ import os
 ssmClient = boto3.client('ssm')
 dynamoClient = boto3.client('dynamodb')
 resourceTag = os.environ['ResourceTag']
+requestRegistered = 'registered'
+activationIndexPrefix = 'activation#'
 
 
 def checkType(instanceId):
@@ -31,17 +33,37 @@ def tagsToObject(tags):
     return tagObject
 
 
-def persistToDynamoDb(instanceId, tagObject):
+def deviceFromActivation(instanceId):
+    # Pooled activations are created before a device claims them, so they
+    # carry no Name tag; the claim writes an activation id -> device index.
+    instances = ssmClient.describe_instance_information(
+        Filters=[{'Key': 'InstanceIds', 'Values': [instanceId]}]
+    )
+    for instance in instances['InstanceInformationList']:
+        if 'ActivationId' not in instance:
+            continue
+        response = dynamoClient.get_item(
+            TableName=resourceTag,
+            Key={'device': {
+                'S': activationIndexPrefix + instance['ActivationId']}}
+        )
+        if 'Item' in response:
+            return response['Item']['owner']['S']
+    raise Exception('No device found for instance {}'.format(instanceId))
+
+
+def persistToDynamoDb(instanceId, device_id):
     dynamoClient.update_item(
         TableName=resourceTag,
         Key={
             'device': {
-                'S': tagObject['Name']
+                'S': device_id
             }
         },
-        UpdateExpression="set instance_id=:i",
+        UpdateExpression="set instance_id=:i, request_state=:r remove request_time",
         ExpressionAttributeValues={
-            ':i': {'S': instanceId}
+            ':i': {'S': instanceId},
+            ':r': {'S': requestRegistered}
         }
     )
 
@@ -56,7 +78,11 @@ def handler(event, context):
             instanceId = event['detail']['instance-id']
             tags = checkType(instanceId)
             tagObject = tagsToObject(tags)
-            persistToDynamoDb(instanceId, tagObject)
+            if 'Name' in tagObject:
+                device_id = tagObject['Name']
+            else:
+                device_id = deviceFromActivation(instanceId)
+            persistToDynamoDb(instanceId, device_id)
 
             print('...........'+instanceId+' Created.............')
 
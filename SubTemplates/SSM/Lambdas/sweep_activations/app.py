@@ -0,0 +1,76 @@
+import boto3
+import os
+import time
+
+ssmClient = boto3.client('ssm')
+dynamoClient = boto3.client('dynamodb')
+
+resourceTag = os.environ['ResourceTag']
+timeout = int(os.environ.get('ActivationTimeout', 120))
+
+requestPending = 'pending'
+requestTimeout = 'timeout'
+# Sparse index: only requests still waiting for the device carry
+# request_time, so a query reads just those instead of the whole table.
+pendingRequestsIndex = 'pending_requests'
+
+
+def queryExpiredRequests(cutoff):
+    paginator = dynamoClient.get_paginator('query')
+    pages = paginator.paginate(
+        TableName=resourceTag,
+        IndexName=pendingRequestsIndex,
+        KeyConditionExpression='request_state = :p AND request_time < :c',
+        ExpressionAttributeValues={
+            ':p': {'S': requestPending},
+            ':c': {'N': str(cutoff)}
+        }
+    )
+    for page in pages:
+        for item in page['Items']:
+            yield item
+
+
+def expireRequest(item):
+    # Conditional on the request still being the pending one we queried, so a
+    # registration event or a new activation that lands meanwhile wins.
+    dynamoClient.update_item(
+        TableName=resourceTag,
+        Key={'device': item['device']},
+        UpdateExpression='set request_state=:t remove activation_data, request_time',
+        ConditionExpression='request_state = :p AND request_token = :k',
+        ExpressionAttributeValues={
+            ':t': {'S': requestTimeout},
+            ':p': {'S': requestPending},
+            ':k': item['request_token']
+        }
+    )
+
+
+def deleteActivation(activationId):
+    try:
+        ssmClient.delete_activation(
+            ActivationId=activationId
+        )
+    except Exception as e:
+        print(e)
+
+
+def handler(event, context):
+    expired = 0
+    cutoff = int(time.time()) - timeout
+    for item in queryExpiredRequests(cutoff):
+        id = item['device']['S']
+        try:
+            expireRequest(item)
+        except dynamoClient.exceptions.ConditionalCheckFailedException:
+            continue
+        except Exception as e:
+            print('error expiring request for device {}: {}'.format(id, e))
+            continue
+        if 'activation_data' in item:
+            deleteActivation(
+                item['activation_data']['M']['activationId']['S'])
+        print('Timeout Occured when trying to register device: {}'.format(id))
+        expired = expired + 1
+    return {'expired': expired}
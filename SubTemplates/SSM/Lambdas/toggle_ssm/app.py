@@ -3,21 +3,71 @@ import copy
 import datetime
 import json
 import os
+import random
+import threading
 import time
+import uuid
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import RateLimiter
 
-ssmClient = boto3.client('ssm')
+ssmClient = boto3.client('ssm', config=Config(
+    retries={'max_attempts': 10, 'mode': 'adaptive'}))
 dynamoClient = boto3.client('dynamodb')
 iotClient = boto3.client('iot-data')
+iotControlClient = boto3.client('iot')
 
 resourceTag = os.environ['ResourceTag']
 automationServiceRole = os.environ['AutomationServiceRole']
 stateProvisioned = os.environ['StateProvisioned']
+createActivationTps = float(os.environ.get('CreateActivationTps', 5))
+bulkWorkers = int(os.environ.get('BulkWorkers', 16))
+activationPoolSize = int(os.environ.get('ActivationPoolSize', 0))
 
 replaceCharacter = 'DEVICE_ID'
 activateTopic = 'cmd/{}/ssm/activate'.format(replaceCharacter)
 deactivateTopic = 'cmd/{}/ssm/deactivate'.format(replaceCharacter)
-dynamoUpdateExpression = "set activation_data=:a"
-timeout = 120
+# request_time puts the request in the sweeper's pending_requests index, also
+# for synchronous requests, so one whose invocation died is still expired.
+dynamoUpdateExpression = "set activation_data=:a, request_token=:t, request_state=:s, request_time=:r"
+timeout = int(os.environ.get('ActivationTimeout', 120))
+
+requestPending = 'pending'
+requestRegistered = 'registered'
+requestTimeout = 'timeout'
+requestInactive = 'inactive'
+requestDeactivated = 'deactivated'
+requestFailed = 'failed'
+requestDeferred = 'deferred'
+
+batchGetLimit = 100
+
+poolPrefix = 'activation_pool#'
+activationIndexPrefix = 'activation#'
+poolAvailable = 'available'
+poolClaimed = 'claimed'
+# Only hand out pooled activations with at least this long left to live,
+# matching the window a freshly created activation used to get.
+poolMinRemaining = datetime.timedelta(days=2)
+deadlineMarginMillis = 15000
+
+# Pool slots that looked available when the pool was read, shared by every
+# claim in one invocation (bulk workers included) so the pool is read once
+# and not at all once it is known to be empty. Reset by the handler.
+poolCandidates = None
+poolLock = threading.Lock()
+
+# Calls per second for each SSM API, shared by every worker of a bulk run so
+# a large batch is paced by the API limits rather than by throttling errors.
+ssmLimiters = {
+    'CreateActivation': RateLimiter(createActivationTps),
+    'DeleteActivation': RateLimiter(10),
+    'DeregisterManagedInstance': RateLimiter(10)
+}
+
+
+def limited(api):
+    ssmLimiters[api].acquire()
 
 
 def dynamoGet(device_id):
@@ -87,8 +137,70 @@ def iotPublish(topic, payload):
     )
 
 
+def nextPoolCandidate(minExpires):
+    global poolCandidates
+    with poolLock:
+        if poolCandidates is None:
+            slots = dynamoBatchGet(['{}{}'.format(poolPrefix, slot)
+                                    for slot in range(activationPoolSize)])
+            poolCandidates = [key for key, item in slots.items()
+                              if item.get('pool_state', {}).get('S') == poolAvailable and
+                              int(item['expires']['N']) > minExpires]
+            # Random order, so concurrent invocations rarely race for a slot.
+            random.shuffle(poolCandidates)
+        return poolCandidates.pop() if poolCandidates else None
+
+
+def claimPooledActivation(device_id):
+    minExpires = int(time.time() + poolMinRemaining.total_seconds())
+    # The conditional update settles a race with another invocation or a
+    # stale read; the next candidate is tried until none are left.
+    while True:
+        key = nextPoolCandidate(minExpires)
+        if key is None:
+            return None
+        try:
+            response = dynamoClient.update_item(
+                TableName=resourceTag,
+                Key={'device': {'S': key}},
+                UpdateExpression='set pool_state=:c, claimed_by=:d',
+                ConditionExpression='pool_state = :a AND expires > :m',
+                ExpressionAttributeValues={
+                    ':c': {'S': poolClaimed},
+                    ':d': {'S': device_id},
+                    ':a': {'S': poolAvailable},
+                    ':m': {'N': str(minExpires)}
+                },
+                ReturnValues='ALL_NEW'
+            )
+        except dynamoClient.exceptions.ConditionalCheckFailedException:
+            continue
+        return response['Attributes']
+
+
+def dynamoIndexActivation(device_id, slot):
+    dynamoPut({
+        'device': {'S': activationIndexPrefix + slot['activationId']['S']},
+        'owner': {'S': device_id},
+        'ttl': slot['expires']
+    })
+
+
 def createActivationShell(device_id):
+    if activationPoolSize > 0:
+        slot = claimPooledActivation(device_id)
+        if slot:
+            dynamoIndexActivation(device_id, slot)
+            return {
+                'device': device_id,
+                'activationId': slot['activationId']['S'],
+                'activationCode': slot['activationCode']['S'],
+                'expirationDate': slot['expirationDate']['S']
+            }
+        print('activation pool empty, creating activation for {}'.format(device_id))
+
     expirationDate = datetime.datetime.today() + datetime.timedelta(days=2)
+    limited('CreateActivation')
     response = createActivation(device_id, expirationDate)
 
     data = {}
@@ -99,7 +211,7 @@ def createActivationShell(device_id):
     return data
 
 
-def dynamoActivateUpdate(device_id, data):
+def dynamoActivateUpdate(device_id, data, requestToken):
     values = {
         ':a': {
             'M': {
@@ -113,7 +225,10 @@ def dynamoActivateUpdate(device_id, data):
                     'S': data['expirationDate']
                 }
             }
-        }
+        },
+        ':t': {'S': requestToken},
+        ':s': {'S': requestPending},
+        ':r': {'N': str(int(time.time()))}
     }
     dynamoUpdate(device_id, dynamoUpdateExpression, values)
 
@@ -124,6 +239,9 @@ def dynamoDeactivatePut(data):
         del payload['activation_data']
     if 'instance_id' in payload:
         del payload['instance_id']
+    for key in ['request_token', 'request_state', 'request_time']:
+        if key in payload:
+            del payload[key]
     dynamoPut(payload)
 
 
@@ -148,17 +266,47 @@ def waitForRegister(id):
             activationProcessing = False
         else:
             if i * queryDt >= timeout:
-                deleteActivation(data['activation_data']
-                                 ['M']['activationId']['S'])
+                # The sweeper may have expired the request meanwhile.
+                if 'activation_data' in data:
+                    deleteActivation(data['activation_data']
+                                     ['M']['activationId']['S'])
                 dynamoDeactivatePut(data)
                 activationProcessing = False
             i = i + 1
     return message
 
 
+def dynamoBatchGet(device_ids):
+    items = {}
+    for i in range(0, len(device_ids), batchGetLimit):
+        keys = [{'device': {'S': id}}
+                for id in device_ids[i:i + batchGetLimit]]
+        request = {resourceTag: {'Keys': keys}}
+        attempt = 0
+        while request:
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+            response = dynamoClient.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(resourceTag, []):
+                items[item['device']['S']] = item
+            request = response.get('UnprocessedKeys')
+            attempt = attempt + 1
+    return items
+
+
+def listThingGroupDevices(thingGroup):
+    device_ids = []
+    paginator = iotControlClient.get_paginator('list_things_in_thing_group')
+    for page in paginator.paginate(thingGroupName=thingGroup):
+        device_ids.extend(page['things'])
+    return device_ids
+
+
 def validateDeviceId(event):
-    action = event['action']
-    data = dynamoGet(event['device_id'])
+    return validateDeviceData(event['action'], dynamoGet(event['device_id']))
+
+
+def validateDeviceData(action, data):
     id = data['device']['S']
     if data['state']['S'] != stateProvisioned:
         raise Exception('Device has not been provisioned')
@@ -167,40 +315,145 @@ def validateDeviceId(event):
         message = 'Device {} is already registered in SSM. Instance Id: {}'.format(
             id, instance_id)
         raise Exception(message)
+    if action == 'activate' and requestState(data) == requestPending:
+        raise Exception(
+            'Device {} already has a pending activation request'.format(id))
     if action == 'deactivate' and 'instance_id' not in data:
         raise Exception('Device {} is not registered in SSM'.format(id))
     return data
 
 
+def requestState(data):
+    if 'instance_id' in data:
+        return requestRegistered
+    if 'request_state' in data:
+        return data['request_state']['S']
+    return requestInactive
+
+
+def requestStatus(data, requestToken=None):
+    id = data['device']['S']
+    token = data['request_token']['S'] if 'request_token' in data else None
+    if requestToken and requestToken != token:
+        raise Exception(
+            'Unknown request token {} for device {}'.format(requestToken, id))
+    status = {
+        'device_id': id,
+        'requestToken': token,
+        'state': requestState(data)
+    }
+    if 'instance_id' in data:
+        status['instanceId'] = data['instance_id']['S']
+    return status
+
+
+def isAsync(event):
+    return str(event.get('async', False)).lower() == 'true'
+
+
+def startActivation(id):
+    data = createActivationShell(id)
+    requestToken = str(uuid.uuid4())
+    dynamoActivateUpdate(id, data, requestToken)
+    topic = activateTopic.replace(replaceCharacter, id)
+    iotPublish(topic, data)
+    return requestToken
+
+
+def deactivateDevice(id, data):
+    topic = deactivateTopic.replace(replaceCharacter, id)
+    # messageId lets the device drop a redelivered deactivate.
+    iotPublish(topic, {'message': 'uninstall ssm', 'messageId': str(uuid.uuid4())})
+    if 'activation_data' in data:
+        limited('DeleteActivation')
+        deleteActivation(data['activation_data']['M']['activationId']['S'])
+    dynamoDeactivatePut(data)
+    limited('DeregisterManagedInstance')
+    deregisterInstance(data['instance_id']['S'])
+
+
 def activateSsm(event, message):
     if event['action'].lower() == 'activate':
         id = event['device_id']
-        data = createActivationShell(id)
-        dynamoActivateUpdate(id, data)
-        topic = activateTopic.replace(replaceCharacter, id)
-        iotPublish(topic, data)
-        message = waitForRegister(id)
+        requestToken = startActivation(id)
+        if isAsync(event):
+            message = {
+                'device_id': id,
+                'requestToken': requestToken,
+                'state': requestPending
+            }
+        else:
+            message = waitForRegister(id)
     return message
 
 
 def deactivateSsm(event, data, message):
     if event['action'].lower() == 'deactivate':
         id = event['device_id']
-        topic = deactivateTopic.replace(replaceCharacter, id)
-        iotPublish(topic, {'message': 'uninstall ssm'})
-        deleteActivation(data['activation_data']['M']['activationId']['S'])
-        dynamoDeactivatePut(data)
-        deregisterInstance(data['instance_id']['S'])
+        deactivateDevice(id, data)
         message = '{} SSM instance deregistered'.format(id)
     return message
 
 
+def statusSsm(event, data, message):
+    if event['action'].lower() == 'status':
+        message = requestStatus(data, event.get('request_token'))
+    return message
+
+
+def isBulk(event):
+    return 'device_ids' in event or 'thing_group' in event
+
+
+def bulkDevice(action, id, data, context):
+    if context.get_remaining_time_in_millis() < deadlineMarginMillis:
+        return {'state': requestDeferred}
+    try:
+        if data is None:
+            raise Exception('No device with this id')
+        validateDeviceData(action, data)
+        if action == 'activate':
+            requestToken = startActivation(id)
+            return {'state': requestPending, 'requestToken': requestToken}
+        deactivateDevice(id, data)
+        return {'state': requestDeactivated}
+    except Exception as e:
+        return {'state': requestFailed, 'message': str(e)}
+
+
+def bulkToggle(event, context):
+    action = event['action'].lower()
+    if action not in ['activate', 'deactivate']:
+        raise Exception('Bulk action must be activate or deactivate')
+    device_ids = list(event.get('device_ids', []))
+    if 'thing_group' in event:
+        device_ids.extend(listThingGroupDevices(event['thing_group']))
+    device_ids = list(dict.fromkeys(device_ids))
+    items = dynamoBatchGet(device_ids)
+
+    with ThreadPoolExecutor(max_workers=bulkWorkers) as executor:
+        futures = {id: executor.submit(bulkDevice, action, id, items.get(id), context)
+                   for id in device_ids}
+    results = {id: future.result() for id, future in futures.items()}
+
+    counts = {}
+    for result in results.values():
+        counts[result['state']] = counts.get(result['state'], 0) + 1
+    print('bulk {}: {}'.format(action, counts))
+    return {'action': action, 'counts': counts, 'results': results}
+
+
 def handler(event, context):
+    global poolCandidates
+    poolCandidates = None
     try:
+        if isBulk(event):
+            return bulkToggle(event, context)
         message = ''
         data = validateDeviceId(event)
         message = activateSsm(event, message)
         message = deactivateSsm(event, data, message)
+        message = statusSsm(event, data, message)
     except Exception as e:
         print(e)
         message = str(e)
@@ -0,0 +1,298 @@
+# ------------------------------------------------------------------------------
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# -----------------------------------------
+# Bulk loads white listed device serials from a manufacturing CSV into the
+# ResourceTag DynamoDB table read by lambda_hook and toggle_ssm.
+#
+#  The CSV is streamed row by row and written in 25 item BatchWriteItem calls
+#  by a pool of workers. UnprocessedItems and UnprocessedKeys are retried with
+#  exponential backoff and full jitter, up to maxAttempts times per batch; a
+#  batch that still fails is left for the next run to resume. Progress is checkpointed to <csv>.checkpoint after every
+#  contiguous run of completed batches so a crashed run resumes where it left
+#  off; rerunning a finished import is a no-op unless --restart is given.
+#  Devices already in the table are left untouched unless --overwrite is
+#  given, since a put replaces the whole item (state, instance_id, ...).
+#
+#  lambda_hook rejects every serial missing from the bloom filter, so it must
+#  cover the whole white list, not just one CSV: --bloom-out scans the table
+#  once the import has finished and writes a filter of every device in it.
+#
+#  Usage:
+#      python Tools/import_whitelist.py serials.csv --table ssmondemand
+#      python Tools/import_whitelist.py serials.csv --table ssmondemand \
+#          --bloom-out whitelist.bloom
+#      aws s3 cp whitelist.bloom s3://<ClientBucket>/whitelist/whitelist.bloom
+# ------------------------------------------------------------------------------
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+batchSize = 25
+checkpointInterval = 5
+maxBackoff = 20
+maxAttempts = 10
+
+
+class Checkpoint:
+    """Tracks completed batches and persists the highest row below which
+    every batch is done."""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.lock = threading.RLock()
+        self.done = set()
+        self.nextBatch = 0
+        self.committedRows = 0
+        self.batchEnds = {}
+        self.saved = 0
+        if os.path.exists(path):
+            with open(path) as checkpointFile:
+                data = json.load(checkpointFile)
+            if data['source'] == source:
+                self.committedRows = data['committedRows']
+
+    def complete(self, batch, endRow):
+        with self.lock:
+            self.done.add(batch)
+            self.batchEnds[batch] = endRow
+            while self.nextBatch in self.done:
+                self.done.remove(self.nextBatch)
+                self.committedRows = self.batchEnds.pop(self.nextBatch)
+                self.nextBatch += 1
+            if time.time() - self.saved > checkpointInterval:
+                self.save()
+
+    def save(self):
+        with self.lock:
+            tmpPath = self.path + '.tmp'
+            with open(tmpPath, 'w') as checkpointFile:
+                json.dump({'source': self.source,
+                           'committedRows': self.committedRows}, checkpointFile)
+                checkpointFile.flush()
+                os.fsync(checkpointFile.fileno())
+            os.replace(tmpPath, self.path)
+            self.saved = time.time()
+
+
+def readRows(path, column, modelColumn):
+    with open(path, newline='') as csvFile:
+        for row in csv.DictReader(csvFile):
+            serial = (row.get(column) or '').strip()
+            if serial:
+                yield serial, (row.get(modelColumn) or '').strip()
+
+
+def toItem(serial, modelType, state):
+    item = {'device': {'S': serial}, 'state': {'S': state}}
+    if modelType:
+        item['model_type'] = {'S': modelType}
+    return item
+
+
+def backoff(attempt, stats, remaining):
+    if attempt == maxAttempts:
+        raise Exception('{} keys still unprocessed after {} attempts'.format(
+            remaining, maxAttempts))
+    stats.add('retries', 1)
+    time.sleep(random.uniform(0, min(maxBackoff, 0.05 * 2 ** attempt)))
+
+
+def existingSerials(client, table, serials, stats):
+    request = {table: {
+        'Keys': [{'device': {'S': serial}} for serial in serials],
+        'ProjectionExpression': '#d',
+        'ExpressionAttributeNames': {'#d': 'device'}}}
+    found = set()
+    attempt = 0
+    while request and request.get(table):
+        if attempt:
+            backoff(attempt, stats, len(request[table]['Keys']))
+        response = client.batch_get_item(RequestItems=request)
+        found.update(item['device']['S']
+                     for item in response['Responses'].get(table, []))
+        request = response.get('UnprocessedKeys')
+        attempt += 1
+    return found
+
+
+def tableSerials(client, table, segment, segments):
+    paginator = client.get_paginator('scan')
+    for page in paginator.paginate(
+            TableName=table, Segment=segment, TotalSegments=segments,
+            ProjectionExpression='#d', ExpressionAttributeNames={'#d': 'device'}):
+        for item in page['Items']:
+            yield item['device']['S']
+
+
+def buildBloom(client, args):
+    """Bloom filter of every device in the table, scanned in parallel segments."""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'SubTemplates', 'IoT', 'Lambdas', 'lambda_hook'))
+    from cache import BloomFilter
+    # ItemCount is refreshed about every six hours, so leave room for the rows
+    # just imported; pass --bloom-capacity when the table is changing fast.
+    capacity = args.bloom_capacity or (client.describe_table(
+        TableName=args.table)['Table']['ItemCount'] + args.importedRows)
+    bloom = BloomFilter.forCapacity(capacity, args.bloom_error_rate)
+    lock = threading.Lock()
+    counts = []
+
+    def scanSegment(segment):
+        count = 0
+        for serial in tableSerials(client, args.table, segment, args.workers):
+            with lock:
+                bloom.add(serial)
+            count += 1
+        counts.append(count)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(scanSegment, range(args.workers)))
+    if sum(counts) > capacity:
+        print('table holds {} devices, more than the bloom capacity {}; '
+              'rerun with --bloom-capacity'.format(sum(counts), capacity))
+    return bloom, sum(counts)
+
+
+def writeBatch(client, table, items, skipExisting, stats):
+    if skipExisting:
+        existing = existingSerials(client, table, list(items), stats)
+        items = dict((serial, item) for serial, item in items.items()
+                     if serial not in existing)
+        stats.add('skipped', len(existing))
+    request = {table: [{'PutRequest': {'Item': item}}
+                       for item in items.values()]}
+    attempt = 0
+    while request and request.get(table):
+        if attempt:
+            backoff(attempt, stats, len(request[table]))
+        response = client.batch_write_item(RequestItems=request)
+        request = response.get('UnprocessedItems')
+        attempt += 1
+    stats.add('written', len(items))
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'written': 0, 'skipped': 0, 'retries': 0}
+
+    def __getitem__(self, key):
+        return self.counts[key]
+
+    def add(self, key, value):
+        with self.lock:
+            self.counts[key] += value
+
+
+def importWhitelist(args):
+    client = boto3.client('dynamodb', config=Config(
+        retries={'max_attempts': 10, 'mode': 'adaptive'}))
+    source = '{}:{}'.format(os.path.abspath(args.csv), args.table)
+    checkpoint = Checkpoint(args.csv + '.checkpoint', source)
+    if args.restart:
+        checkpoint.committedRows = 0
+    resumeFrom = checkpoint.committedRows
+    if resumeFrom:
+        print('resuming after row {}'.format(resumeFrom))
+
+    stats = Stats()
+    slots = threading.BoundedSemaphore(args.workers * 2)
+    start = time.time()
+    lastReport = start
+    row = 0
+    batch = 0
+    items = {}
+
+    def submit(executor, batch, items, endRow):
+        slots.acquire()
+        future = executor.submit(writeBatch, client, args.table, items,
+                                 not args.overwrite, stats)
+
+        def done(future):
+            slots.release()
+            if future.exception() is None:
+                checkpoint.complete(batch, endRow)
+            else:
+                print('batch ending at row {} failed: {}'.format(
+                    endRow, future.exception()))
+        future.add_done_callback(done)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for serial, modelType in readRows(args.csv, args.column, args.model_column):
+            row += 1
+            if row <= resumeFrom:
+                continue
+            # BatchWriteItem rejects duplicate keys within one request.
+            items[serial] = toItem(serial, modelType, args.state)
+            if len(items) == batchSize:
+                submit(executor, batch, items, row)
+                batch += 1
+                items = {}
+            if time.time() - lastReport > 10:
+                lastReport = time.time()
+                print('{} rows written, {:.0f} rows/s'.format(
+                    stats['written'], stats['written'] / (lastReport - start)))
+        if items:
+            submit(executor, batch, items, row)
+            batch += 1
+    checkpoint.save()
+
+    elapsed = max(time.time() - start, 1e-6)
+    print('rows read: {}, written: {}, skipped existing: {}, retries: {}'.format(
+        row, stats['written'], stats['skipped'], stats['retries']))
+    print('elapsed: {:.1f}s, {:.0f} rows/s'.format(
+        elapsed, stats['written'] / elapsed))
+    if checkpoint.committedRows < row:
+        print('import incomplete, rerun to resume after row {}'.format(
+            checkpoint.committedRows))
+        return 1
+    if args.bloom_out:
+        args.importedRows = row
+        bloom, devices = buildBloom(client, args)
+        with open(args.bloom_out, 'wb') as bloomFile:
+            bloomFile.write(bloom.toBytes())
+        print('bloom filter of {} devices written to {} ({} bits, {} hashes)'.format(
+            devices, args.bloom_out, bloom.size, bloom.hashes))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bulk white list device serials in DynamoDB')
+    parser.add_argument('csv', help='CSV file with a header row')
+    parser.add_argument('--table', required=True,
+                        help='DynamoDB table (the stack ResourceTag)')
+    parser.add_argument('--column', default='device',
+                        help='CSV column holding the serial')
+    parser.add_argument('--model-column', default='model_type')
+    parser.add_argument('--state', default='white_listed',
+                        help='value of the StateWhiteList stack parameter')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace devices already in the table, resetting their state')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint and import from the first row')
+    parser.add_argument('--bloom-out',
+                        help='also write a bloom filter of every device in the table '
+                             'for lambda_hook')
+    parser.add_argument('--bloom-capacity', type=int,
+                        help='devices the bloom filter is sized for '
+                             '(default: table ItemCount plus the CSV rows)')
+    parser.add_argument('--bloom-error-rate', type=float, default=0.01)
+    sys.exit(importWhitelist(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()